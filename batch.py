@@ -0,0 +1,111 @@
+'''
+run many independent scenarios across a pool of worker processes.
+
+a scenario is a program, either assembler source or a list of 14 bit program words, the
+registers to preset before it starts, the limits to pass to Pic.simulate and the registers to
+read back when it stops.  scenarios must pickle so stop conditions are given as limits such as
+max_cycles and stop_at rather than lambdas.
+
+each worker builds its Decoder and Pic once when it starts, as do the workers of a sweep.
+programs are decoded once per worker and the state just after loading a program is snapshot so the next scenario running
+the same program only restores the pages that changed rather than clearing and loading again.
+scenarios are handed out in chunks in the order given so keep those sharing a program together.
+'''
+
+import io
+import os
+import contextlib
+import collections
+import concurrent.futures
+
+import pic
+import insdata
+
+INC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'p16f1826.inc')
+
+Scenario = collections.namedtuple('Scenario', 'name program presets limits registers',
+                                  defaults=(None, None, ()))
+
+# registers is a tuple of the values of the scenario's registers in the same order
+Result = collections.namedtuple('Result', 'name reason cycles instructions registers')
+
+# per worker process state set up by init.  _loaded is the key of the program in program
+# memory and the snapshot taken just after loading it
+_decoder = None
+_pic = None
+_compiled = False
+_programs = {}
+_loaded = None
+
+
+def init(inc_file=INC_FILE, compiled=False):
+    ''' build the decoder and simulator a worker runs every scenario on '''
+    global _decoder, _pic, _compiled, _loaded
+    _decoder = pic.Decoder(insdata.ENHMID, inc_file)
+    _pic = pic.Pic(_decoder)
+    _compiled = compiled
+    _programs.clear()
+    _loaded = None
+
+
+def decode(program):
+    ''' decoded instructions and symtab of a program given as source or words, cached by
+    program '''
+    key = program if isinstance(program, str) else tuple(program)
+    decoded = _programs.get(key)
+    if decoded is None:
+        if isinstance(program, str):
+            # the assembler prints its symbol table
+            with contextlib.redirect_stdout(io.StringIO()):
+                decoded = _decoder.assemble(program)
+        else:
+            decoded = [_decoder.decode(word) for word in program], {}
+        _programs[key] = decoded
+    return key, decoded
+
+
+def load(program):
+    ''' this process's simulator cleared with program loaded and the program's symtab '''
+    global _loaded
+    key, (code, symtab) = decode(program)
+    _pic.clear()
+    _pic.load_program(0, code)
+    _loaded = None
+    return _pic, symtab
+
+
+def run_scenario(scenario):
+    ''' run one scenario on this process's simulator '''
+    global _loaded
+    key, _ = decode(scenario.program)
+    if _loaded is not None and _loaded[0] == key:
+        p = _pic
+        p.restore(_loaded[1])
+    else:
+        p, _ = load(scenario.program)
+        _loaded = key, p.snapshot()
+
+    for register, value in (scenario.presets or {}).items():
+        p.data[register] = value
+
+    result = p.simulate(compiled=_compiled, **(scenario.limits or {}))
+    registers = tuple(p.data[register] for register in scenario.registers)
+    return Result(scenario.name, result.reason, result.cycles, result.instructions, registers)
+
+
+def run(scenarios, workers=None, inc_file=INC_FILE, compiled=False, chunksize=None):
+    ''' run scenarios on a pool of workers and return their results in the same order.
+    workers defaults to the number of cpus.  one worker runs in this process '''
+    scenarios = list(scenarios)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        init(inc_file, compiled)
+        return [run_scenario(scenario) for scenario in scenarios]
+
+    # a few chunks per worker keeps them all busy to the end without much traffic
+    if chunksize is None:
+        chunksize = max(1, len(scenarios) // (workers * 4))
+
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=init, initargs=(inc_file, compiled)) as executor:
+        return list(executor.map(run_scenario, scenarios, chunksize=chunksize))
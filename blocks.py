@@ -0,0 +1,199 @@
+'''
+basic block compiler for the Pic simulator.
+
+a basic block is a straight run of program memory that is entered at the top and only leaves
+at the bottom.  it ends after any instruction that transfers control or may skip (GOTO, CALL,
+BRA, RETURN, DECFSZ, BTFSC, ...) and after any instruction that can read or write PCL, either
+as file register 0x02 in any bank or indirectly through an FSR (MOVIW/MOVWI).  only that last
+instruction can observe the program counter so it is the only one pc and ins_pc are set for.
+
+each block is compiled into one generated python function.  the function adds the cycles of
+every instruction in the block to the profile and the running totals up front and then runs
+the instructions in order.  the common data movement, logic and add/subtract instructions are
+written out inline as operations on the data memory bytearray.  anything else, and any
+instruction addressing STATUS, calls its pre-decoded handler with the instruction bound as a
+constant.  skip instructions add their extra cycle themselves exactly as they do when single
+stepping so the profile and cycle count match the interpreter.
+
+blocks are cached by start address.  the owner invalidates the cache when program memory
+changes.
+'''
+
+import isa
+
+# instructions after which control may not continue at the next address
+BRANCHES = {'BRA', 'BRW', 'CALL', 'CALLW', 'GOTO', 'RESET', 'RETFIE', 'RETLW', 'RETURN', 'SLEEP',
+            'BTFSC', 'BTFSS', 'DECFSZ', 'INCFSZ'}
+
+# inline source for instructions.  {cell} is the banked data memory cell of f, {w}, {s} and
+# {bsr} are the cells of WREG, STATUS and BSR.  a write to the cell of f flags it in dirty for
+# snapshots.  zflag sets Z from v the way the Pic z property does, bringing any deferred
+# arithmetic flags up to date first
+ZFLAG = [
+    'if pic.alu:',
+    '    pic.sync_status()',
+    'mem[{s}] = (mem[{s}] & {nz}) if v else (mem[{s}] | {z})',
+]
+
+INLINE = {
+    'NOP': [],
+    'CLRWDT': [],
+    'MOVLW': ['mem[{w}] = {k}'],
+    'MOVLB': ['mem[{bsr}] = {k}'],
+    'MOVLP': ['mem[{pclath}] = {k}'],
+    'MOVWF': ['c = {cell}', 'mem[c] = mem[{w}]', 'dirty[c] = 1'],
+    'CLRF': ['c = {cell}', 'mem[c] = 0', 'dirty[c] = 1', 'v = 0'] + ZFLAG,
+    'CLRW': ['mem[{w}] = 0', 'v = 0'] + ZFLAG,
+    'BSF': ['c = {cell}', 'mem[c] |= {bit}', 'dirty[c] = 1'],
+    'BCF': ['c = {cell}', 'mem[c] &= {nbit}', 'dirty[c] = 1'],
+    'MOVF0': ['v = mem[{cell}]', 'mem[{w}] = v'] + ZFLAG,
+    'MOVF1': ['v = mem[{cell}]'] + ZFLAG,
+    'INCF0': ['v = (mem[{cell}] + 1) & 0xFF', 'mem[{w}] = v'] + ZFLAG,
+    'INCF1': ['c = {cell}', 'v = (mem[c] + 1) & 0xFF', 'mem[c] = v', 'dirty[c] = 1'] + ZFLAG,
+    'ANDLW': ['v = mem[{w}] & {k}', 'mem[{w}] = v'] + ZFLAG,
+    'IORLW': ['v = mem[{w}] | {k}', 'mem[{w}] = v'] + ZFLAG,
+    'XORLW': ['v = mem[{w}] ^ {k}', 'mem[{w}] = v'] + ZFLAG,
+    'ANDWF0': ['v = mem[{cell}] & mem[{w}]', 'mem[{w}] = v'] + ZFLAG,
+    'ANDWF1': ['c = {cell}', 'v = mem[c] & mem[{w}]', 'mem[c] = v', 'dirty[c] = 1'] + ZFLAG,
+    'IORWF0': ['v = mem[{cell}] | mem[{w}]', 'mem[{w}] = v'] + ZFLAG,
+    'IORWF1': ['c = {cell}', 'v = mem[c] | mem[{w}]', 'mem[c] = v', 'dirty[c] = 1'] + ZFLAG,
+    'XORWF0': ['v = mem[{cell}] ^ mem[{w}]', 'mem[{w}] = v'] + ZFLAG,
+    'XORWF1': ['c = {cell}', 'v = mem[c] ^ mem[{w}]', 'mem[c] = v', 'dirty[c] = 1'] + ZFLAG,
+    'ADDLW': ['w = mem[{w}]', 'v = w + {k}', 'mem[{w}] = v & 0xFF', 'pic.alu = w, {k}, 0, v'],
+    'SUBLW': ['w = -mem[{w}] & 0xFF', 'v = w + {k}', 'mem[{w}] = v & 0xFF',
+              'pic.alu = w, {k}, 0, v'],
+    'ADDWF0': ['x = mem[{cell}]', 'w = mem[{w}]', 'v = x + w', 'mem[{w}] = v & 0xFF',
+               'pic.alu = x, w, 0, v'],
+    'ADDWF1': ['c = {cell}', 'x = mem[c]', 'w = mem[{w}]', 'v = x + w', 'mem[c] = v & 0xFF',
+               'dirty[c] = 1', 'pic.alu = x, w, 0, v'],
+    'SUBWF0': ['x = mem[{cell}]', 'w = -mem[{w}] & 0xFF', 'v = w + x', 'mem[{w}] = v & 0xFF',
+               'pic.alu = w, x, 0, v'],
+    'SUBWF1': ['c = {cell}', 'x = mem[c]', 'w = -mem[{w}] & 0xFF', 'v = w + x',
+               'mem[c] = v & 0xFF', 'dirty[c] = 1', 'pic.alu = w, x, 0, v'],
+}
+
+
+class BlockCache:
+    ''' compiled basic blocks of a Pic's program memory keyed by start address '''
+
+    def __init__(self, pic):
+        self.pic = pic
+        self.blocks = {}
+
+        # a block never runs on into one of these addresses.  a run that stops at an
+        # address needs a block to start there
+        self.boundaries = set()
+
+    def invalidate(self):
+        ''' drop every compiled block '''
+        self.blocks.clear()
+
+    def set_boundaries(self, addresses):
+        ''' set addresses blocks must start at and recompile if they changed '''
+        addresses = set(addresses)
+        if addresses != self.boundaries:
+            self.boundaries = addresses
+            self.invalidate()
+
+    def step(self):
+        ''' run the block at pc, falling back to a single instruction if none can be built '''
+        pc = self.pic.pc
+        block = self.blocks.get(pc)
+        if block is None:
+            block = self.blocks[pc] = self.compile(pc)
+        if block is None:
+            self.pic.exec()
+        else:
+            block()
+
+    def terminal(self, ins):
+        ''' True if a block must end after this instruction '''
+        mnemonic = ins.info.mnemonic
+        return mnemonic in BRANCHES or mnemonic in isa.INDIRECT or ins.f == isa.PCL
+
+    def extent(self, address):
+        ''' list of addresses making up the block starting at address '''
+        ops = self.pic.ops
+        addresses = []
+        while address < len(ops) and ops[address] is not self.pic.erased:
+            if ops[address] is self.pic.lazy:
+                # a block ends before an invalid word, which only fails if it is run
+                try:
+                    self.pic.decode_at(address)
+                except ValueError:
+                    if addresses:
+                        break
+                    raise
+            addresses.append(address)
+            if self.terminal(ops[address][1]):
+                break
+            address += 1
+            if address in self.boundaries:
+                break
+        return addresses
+
+    def compile(self, address):
+        ''' generate and compile the function for the block starting at address '''
+        pic = self.pic
+        addresses = self.extent(address)
+        if not addresses:
+            return None
+
+        names = {'pic': pic, 'mem': pic.mem, 'map': pic.map, 'cycles': pic.cycles,
+                 'dirty': pic.dirty, 'ran': pic.ran}
+        lines = []
+
+        # cycle bookkeeping for the whole block, flagging each address in ran for snapshots
+        total = 0
+        for a in addresses:
+            cycles = pic.ops[a][2]
+            total += cycles
+            lines.append('cycles[{}] += {}'.format(a, cycles))
+            lines.append('ran[{}] = 1'.format(a))
+        lines.append('pic.cycle_count += {}'.format(total))
+        lines.append('pic.instruction_count += {}'.format(len(addresses)))
+
+        last = addresses[-1]
+        for a in addresses:
+            handler, ins, cycles = pic.ops[a]
+            if a == last:
+                lines.append('pic.ins_pc = {}'.format(a))
+                lines.append('pic.pc = {}'.format(a + 1))
+            lines.extend(self.emit(a, handler, ins, names))
+
+        source = 'def block():\n' + ''.join('    {}\n'.format(line) for line in lines)
+        exec(source, names)
+
+        block = names['block']
+        block.addresses = addresses
+        return block
+
+    def emit(self, address, handler, ins, names):
+        ''' lines of python source for one instruction of a block '''
+        pic = self.pic
+        key = ins.info.mnemonic
+        if ins.d is not None:
+            key += str(ins.d)
+
+        # STATUS goes through the handlers so deferred flags are synced or dropped, and a
+        # record that has been wrapped always runs its own handler
+        if key in INLINE and ins.f != isa.STATUS and handler == pic.handlers[ins.info]:
+            fields = {
+                'w': pic.cell_wreg,
+                'bsr': pic.cell_bsr,
+                'pclath': pic.cell_pclath,
+                's': pic.cell_status,
+                'z': pic.mask_z,
+                'nz': ~pic.mask_z & 0xFF,
+                'k': ins.k,
+            }
+            if ins.f is not None:
+                fields['cell'] = 'map[(mem[{}] << 7) | {}]'.format(pic.cell_bsr, ins.f)
+            if ins.b is not None:
+                fields['bit'] = 1 << ins.b
+                fields['nbit'] = ~(1 << ins.b) & 0xFF
+            return [line.format(**fields) for line in INLINE[key]]
+
+        names['h{}'.format(address)] = handler
+        names['i{}'.format(address)] = ins
+        return ['h{0}(i{0})'.format(address)]
@@ -0,0 +1,146 @@
+'''
+call graph profile of a Pic run.
+
+the profiler stands in for the Pic's push and pop while it is attached so it only does any
+work on CALL, CALLW, RETURN, RETLW and RETFIE.  every push opens a frame on a shadow call stack
+for the routine being called, its entry address worked out from the calling instruction, and
+every pop closes the top frame.  a closed frame adds one call to its routine and to the edge
+from its caller, with the cycles from the push to the pop as the inclusive cycles of the call.
+exclusive cycles leave out the inclusive cycles of the calls it made.
+
+a routine that recurses only adds the inclusive cycles of its outermost call so they aren't
+counted twice.  returns with no frame open, e.g. a routine started part way through that
+returns to HALT, are passed through.  counted loops whose body calls a routine are not fast
+forwarded while the profiler is attached so every call made in a loop body is counted.  the
+rest still are.  routines are named from an assembler symtab when given one, a later name for
+an address replacing an earlier one so labels win over EQUs declared before them.
+'''
+
+# caller of the routines called from outside any other
+ROOT = None
+
+# address of the interrupt vector a push from anything but a call is taken to enter
+VECTOR = 0x0004
+
+
+class Routine:
+    ''' call count and cycles of a routine '''
+
+    def __init__(self, address, name):
+        self.address = address
+        self.name = name
+        self.calls = 0
+        self.inclusive = 0
+        self.exclusive = 0
+        self.min = None
+        self.max = None
+
+        # calls of this routine open on the shadow stack
+        self.active = 0
+
+    def __repr__(self):
+        return 'Routine({}, calls={}, inclusive={}, exclusive={})'.format(
+            self.name, self.calls, self.inclusive, self.exclusive)
+
+
+class Profiler:
+    ''' shadow call stack kept by hooking a Pic's push and pop.  use as a context manager or
+    attach and detach '''
+
+    def __init__(self, pic, symtab=None):
+        self.pic = pic
+        self.names = {address: name for name, address in (symtab or {}).items()}
+
+        # routines by entry address and (calls, inclusive cycles) by (caller, callee) address
+        self.routines = {}
+        self.edges = {}
+
+        # open frames as [routine, cycle count at entry, inclusive cycles of its calls]
+        self.stack = []
+
+    def __enter__(self):
+        self.attach()
+        return self
+
+    def __exit__(self, *args):
+        self.detach()
+
+    def attach(self):
+        pic = self.pic
+        self._push, self._pop = pic.push, pic.pop
+        pic.push, pic.pop = self.push, self.pop
+
+        # a fast forwarded loop would skip the calls made in its body
+        self.fast_calls = pic.fast_calls
+        pic.fast_calls = False
+
+    def detach(self):
+        del self.pic.push, self.pic.pop
+        self.pic.fast_calls = self.fast_calls
+
+    def routine(self, address):
+        ''' the Routine entered at address, adding it the first time it is called '''
+        routine = self.routines.get(address)
+        if routine is None:
+            name = self.names.get(address, '{:04X}'.format(address))
+            routine = self.routines[address] = Routine(address, name)
+        return routine
+
+    def push(self):
+        pic = self.pic
+        self._push()
+
+        # the handler sets pc after pushing so take the target from the call itself
+        ins = pic.prog[pic.ins_pc]
+        mnemonic = ins.info.mnemonic if ins else None
+        if mnemonic == 'CALL':
+            address = ((pic.pclath & 0x78) << 8) | ins.k
+        elif mnemonic == 'CALLW':
+            address = ((pic.pclath & 0x7F) << 8) | pic.wreg
+        else:
+            address = VECTOR
+
+        routine = self.routine(address)
+        routine.active += 1
+        self.stack.append([routine, pic.cycle_count, 0])
+
+    def pop(self):
+        self._pop()
+        if not self.stack:
+            return
+
+        routine, entry, called = self.stack.pop()
+        routine.active -= 1
+        cycles = self.pic.cycle_count - entry
+        caller = self.stack[-1][0].address if self.stack else ROOT
+        if self.stack:
+            self.stack[-1][2] += cycles
+
+        routine.calls += 1
+        if not routine.active:
+            routine.inclusive += cycles
+        routine.exclusive += cycles - called
+        routine.min = cycles if routine.min is None else min(routine.min, cycles)
+        routine.max = cycles if routine.max is None else max(routine.max, cycles)
+
+        calls, inclusive = self.edges.get((caller, routine.address), (0, 0))
+        self.edges[caller, routine.address] = calls + 1, inclusive + cycles
+
+    def callees(self, address=ROOT):
+        ''' (Routine, calls, inclusive cycles) of each routine called from address '''
+        return [(self.routines[callee], calls, inclusive)
+                for (caller, callee), (calls, inclusive) in sorted(self.edges.items(),
+                                                                  key=lambda e: e[0][1])
+                if caller == address]
+
+    def dump(self):
+        ''' print each routine, most inclusive cycles first, followed by its callees '''
+        print('{:20} {:>8} {:>10} {:>10} {:>8} {:>8}'.format(
+            'routine', 'calls', 'inclusive', 'exclusive', 'min', 'max'))
+        for r in sorted(self.routines.values(), key=lambda r: (-r.inclusive, r.address)):
+            if not r.calls:
+                continue
+            print('{:20} {:8d} {:10d} {:10d} {:8d} {:8d}'.format(
+                r.name, r.calls, r.inclusive, r.exclusive, r.min, r.max))
+            for callee, calls, inclusive in self.callees(r.address):
+                print('    {:16} {:8d} {:10d}'.format(callee.name, calls, inclusive))
@@ -15,31 +15,91 @@ starting at 0x2000
 translate function resolves addresses into a bank, location and linear gpr address.  it also
 accepts addresses as register names which it looks up in a dictionary.
 
-__setitem__ and __getitem__ use the translation function to resolve addresses and then set
-or get a value from the correct region (sfr, gpr)
+both regions live in one bytearray, sfr cells first then gpr.  the translation function is run
+once for every traditional and linear address to build map, a list giving the cell in mem that
+each address resolves to.  __setitem__ and __getitem__ just index map and then mem.  addresses
+with no memory behind them map one past the end of mem so they raise IndexError, as do
+negative addresses rather than indexing map from the end.  map only depends on the size of gpr
+and the number of banks so it is built once for each layout and shared by every DataMem with
+that layout
+
+snapshots hold mem as a tuple of immutable pages.  dirty has a flag for every cell of mem
+that is set by each write, by __setitem__ here and by whatever else writes mem directly: the
+Pic store, compiled blocks and loop fast forwards.  a snapshot taken against the previous one
+reads only the pages with a flag set and shares the rest, and a restore writes back only
+those pages and the ones where the two snapshots differ.  either way the flags are cleared so
+the cost is in what changed, not in the size of mem.  writes that go around the flags, such as
+the core register properties of the Pic, must be marked by their owner
 '''
 
-import array
+# bytes per snapshot page
+PAGESIZE = 0x80
 
-MAXRAM = 0x1000
+# address maps by (maxram, banks)
+_maps = {}
 
 
 class DataMem():
-    def __init__(self, maxram, reg):
+    def __init__(self, maxram, reg, banks=32):
         self.maxram = maxram
-        self.sfr = array.array('B')
-        self.gpr = array.array('B')
-        
+        self.banks = banks
+
+        # 32 special function registers per bank followed by general purpose ram
+        self.sfrsize = banks * 0x20
+        self.mem = bytearray(self.sfrsize + maxram)
+        # cells written since the last snapshot or restore
+        self.dirty = bytearray(len(self.mem))
+        self.sfr = memoryview(self.mem)[:self.sfrsize]
+        self.gpr = memoryview(self.mem)[self.sfrsize:]
+
         # register names
         self.reg = reg
-        
+
+        # end of the traditional and of the linear addresses
+        self.ram = banks * 0x80
+        self.linear = 0x2000 + (banks - 1) * 0x50
+
+        # cell in mem for every traditional and linear address
+        if (maxram, banks) not in _maps:
+            _maps[maxram, banks] = [self.cell(address) for address in range(self.linear)]
+        self.map = _maps[maxram, banks]
+
+        # optional callable run before item access so an owner can bring registers it
+        # updates lazily up to date
+        self.sync = None
+
         self.clear()
 
     def clear(self):
-        # special function registers
-        self.sfr = [0 for i in range(0x20 * 0x20)]
-        # general purpose ram
-        self.gpr = [0 for i in range(self.maxram)]
+        # zero in place so map, sfr and gpr stay valid
+        self.mem[:] = bytes(len(self.mem))
+        self.mark()
+
+    def mark(self):
+        ''' flag every cell as written, for an owner that wrote mem wholesale '''
+        self.dirty[:] = b'\x01' * len(self.dirty)
+
+    def snapshot(self, previous=None):
+        ''' pages of mem, sharing those unwritten since the previous snapshot '''
+        return take_pages(self.mem, self.dirty, previous)
+
+    def restore(self, pages, previous=None):
+        ''' put mem back to a snapshot.  previous is the snapshot mem was last in step with '''
+        put_pages(self.mem, self.dirty, pages, previous)
+
+    def cell(self, address):
+        ''' resolve an address to its cell in mem '''
+        try:
+            bank, location, linear = self.translate(address)
+        except IndexError:
+            return len(self.mem)
+
+        if location < 0x20:
+            return bank * 0x20 + location
+        elif linear < self.maxram:
+            return self.sfrsize + linear
+        else:
+            return len(self.mem)
 
     def translate(self, address):
         ''' translate into bank, location, linear using traditional or linear data addressing '''
@@ -48,7 +108,7 @@ class DataMem():
         address = self.reg[address] if isinstance(address, str) else address
         
         # determine if this is a traditional (0x1000) or linear (0x2000) address
-        if 0 <= address <= 0xFFF:
+        if 0 <= address < self.ram:
             bank, location = divmod(address, 0x80)
             if location <= 0x0B:
                 return 0, location, None
@@ -58,11 +118,11 @@ class DataMem():
                 return 0, location, location - 0x20
             # stack and shadow registers are annoyingly not in SFR space.  As a kludge move them
             # there or they will be mapped to gpr
-            elif bank == 31 and location >= 0x60:
+            elif bank == self.banks - 1 and location >= 0x60:
                 return bank, location - 0x50, location
             else:
                 return bank, location, 0x10 + bank * 0x50 + (location - 0x20)
-        elif 0x2000 <= address <= 0x29AF:
+        elif 0x2000 <= address < self.linear:
             # convert to a bank, location
             bank, location = divmod(address - 0x2000, 0x50)
             if bank == 0:
@@ -73,20 +133,22 @@ class DataMem():
             raise IndexError()
 
     def __getitem__(self, address):
-        bank, location, linear = self.translate(address)
-        #print(address, hex(bank), hex(location), hex(linear))
-        if location < 0x20:
-            return self.sfr[bank * 0x20 + location]
-        else:
-            return self.gpr[linear]
+        if self.sync:
+            self.sync()
+        address = self.reg[address] if isinstance(address, str) else address
+        if address < 0:
+            raise IndexError(address)
+        return self.mem[self.map[address]]
 
     def __setitem__(self, address, value):
-        bank, location, linear = self.translate(address)
-        #print(hex(bank), hex(location), hex(linear))
-        if location < 0x20:
-            self.sfr[bank * 0x20 + location] = value & 0xFF
-        else:
-            self.gpr[linear] = value & 0xFF
+        if self.sync:
+            self.sync()
+        address = self.reg[address] if isinstance(address, str) else address
+        if address < 0:
+            raise IndexError(address)
+        cell = self.map[address]
+        self.mem[cell] = value & 0xFF
+        self.dirty[cell] = 1
             
     def dump(self, addresses):
         for i, address in enumerate(addresses):
@@ -98,3 +160,42 @@ class DataMem():
         else:
             if i % 8 != 7:
                 print()
+
+
+def flagged(dirty, items):
+    ''' indexes of the pages of items flags that have a flag set in dirty '''
+    i = dirty.find(1)
+    while i >= 0:
+        page = i // items
+        yield page
+        i = dirty.find(1, (page + 1) * items)
+
+
+def take_pages(buffer, dirty, previous=None, size=PAGESIZE):
+    ''' tuple of bytes pages of buffer.  against a previous snapshot only the pages with a
+    flag set in dirty, one per item of buffer, are read and the rest are shared.  clears dirty '''
+    view = memoryview(buffer).cast('B')
+    if previous is None:
+        pages = [view[start:start + size].tobytes() for start in range(0, len(view), size)]
+    else:
+        pages = list(previous)
+        for i in flagged(dirty, size * len(dirty) // len(view)):
+            page = view[i * size:(i + 1) * size].tobytes()
+            pages[i] = previous[i] if page == previous[i] else page
+    dirty[:] = bytes(len(dirty))
+    return tuple(pages)
+
+
+def put_pages(buffer, dirty, pages, previous=None, size=PAGESIZE):
+    ''' write pages back to buffer.  buffer is taken to match previous outside of the pages
+    with a flag set in dirty so only those and the pages previous does not share with pages
+    are written, or all of them without previous.  clears dirty '''
+    view = memoryview(buffer).cast('B')
+    if previous is None:
+        changed = range(len(pages))
+    else:
+        changed = set(flagged(dirty, size * len(dirty) // len(view)))
+        changed.update(i for i, page in enumerate(pages) if page is not previous[i])
+    for i in changed:
+        view[i * size:(i + 1) * size] = pages[i]
+    dirty[:] = bytes(len(dirty))
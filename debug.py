@@ -0,0 +1,204 @@
+'''
+breakpoints and watchpoints.
+
+breakpoints are program addresses.  those that always stop are passed to Pic.simulate as
+stop_at so compiled runs start a block at each of them and the run loop checks them along with
+its other limits.  a breakpoint with a condition is checked by the until test of the run
+along with the watches, after every instruction, and the run carries on past it while the
+condition isn't met.  either way a run is one call of simulate so its loop is built once.
+
+watchpoints are on data addresses.  each one sets bits in a flag array with a byte for every
+data memory cell so every address that maps to the same cell, banked, linear or common ram,
+trips it.  while any are set the Pic's load, store, load_indirect and store_indirect are
+replaced by versions that check the flag of the cell they touch before doing the access, and
+the run single steps so it stops right after the instruction that tripped one.  change
+watches compare the value of their cell after every instruction so they also see writes that
+don't go through f or an FSR, e.g. to W or STATUS by an ALU instruction.
+
+a run with nothing set is a plain Pic.simulate.  counted loops are not fast forwarded while
+any breakpoint or watch is set, simulate turns them off for a run with stop_at or until, so
+a breakpoint in a delay loop stops on every iteration.
+
+every run returns a Stop with a snapshot of the machine state it stopped in.  restoring it
+with Pic.restore goes back there, so a long run can be bisected by running to a cycle count,
+checking, and restoring.
+'''
+
+import collections
+
+import pic
+
+# why a run stopped, the pc it stopped at, the Hit of a watch, the cycles, instructions and
+# host seconds the run took and a snapshot of the machine
+Stop = collections.namedtuple('Stop', 'reason pc hit cycles instructions elapsed snapshot')
+
+# the data address of a watch, the access that tripped it, read, write or change, and the
+# value read, written or changed to
+Hit = collections.namedtuple('Hit', 'address access value')
+
+# a watch on address for an access mode with an optional condition(pic, value)
+Watch = collections.namedtuple('Watch', 'address mode condition')
+
+READ = 1
+WRITE = 2
+CHANGE = 4
+
+MODES = {'r': READ, 'w': WRITE, 'rw': READ | WRITE, 'change': CHANGE}
+
+
+class Debugger:
+    ''' breakpoints and watchpoints on a Pic.  addresses may be labels of symtab '''
+
+    def __init__(self, pic, symtab=None):
+        self.pic = pic
+        self.symtab = symtab or {}
+
+        # conditions by breakpoint address, None for one that always stops
+        self.breakpoints = {}
+
+        # watches by data memory cell and the flags of every cell.  the extra flag is for
+        # addresses with no memory behind them
+        self.watches = {}
+        self.flags = bytearray(len(pic.mem) + 1)
+
+        # last values of cells with a change watch
+        self.values = {}
+
+        # what tripped during the current instruction
+        self.hit = None
+
+        # conditions of the conditional breakpoints of the current run
+        self.conditions = {}
+
+    def address(self, label):
+        return pic.lookup(self.symtab, label)
+
+    def set_break(self, address, condition=None):
+        ''' stop when pc reaches address and condition(pic), if given, is true '''
+        self.breakpoints[self.address(address)] = condition
+
+    def clear_break(self, address):
+        del self.breakpoints[self.address(address)]
+
+    def watch(self, address, mode='w', condition=None):
+        ''' stop after an instruction reads, writes or changes a data address.  mode is one of
+        r, w, rw or change and condition(pic, value) must be true if given '''
+        if mode not in MODES:
+            raise ValueError('unknown watch mode {}'.format(mode))
+        address = self.address(address)
+        cell = self.pic.map[address]
+        self.watches.setdefault(cell, []).append(Watch(address, mode, condition))
+        self.flags[cell] |= MODES[mode]
+
+    def unwatch(self, address):
+        ''' remove every watch on address '''
+        address = self.address(address)
+        cell = self.pic.map[address]
+        self.watches[cell] = [w for w in self.watches.get(cell, ()) if w.address != address]
+        if not self.watches[cell]:
+            del self.watches[cell]
+        self.flags[cell] = 0
+        for w in self.watches.get(cell, ()):
+            self.flags[cell] |= MODES[w.mode]
+
+    def trip(self, cell, access, value):
+        ''' record a hit on cell if one of its watches matches '''
+        for w in self.watches[cell]:
+            if MODES[w.mode] & access and (w.condition is None or w.condition(self.pic, value)):
+                if self.hit is None:
+                    self.hit = Hit(w.address, {READ: 'read', WRITE: 'write'}.get(access,
+                                   'change'), value)
+                return
+
+    def attach(self):
+        ''' put the checking load and store functions in place '''
+        pic = self.pic
+        mem, cells, flags = pic.mem, pic.map, self.flags
+        cell_bsr, linear = pic.cell_bsr, pic.data.linear
+        load, store = pic.load, pic.store
+        load_indirect, store_indirect = pic.load_indirect, pic.store_indirect
+        trip = self.trip
+
+        def checked_load(f):
+            value = load(f)
+            cell = cells[(mem[cell_bsr] << 7) | f]
+            if flags[cell] & READ:
+                trip(cell, READ, value)
+            return value
+
+        def checked_store(f, value):
+            cell = cells[(mem[cell_bsr] << 7) | f]
+            if flags[cell] & WRITE:
+                trip(cell, WRITE, value & 0xFF)
+            store(f, value)
+
+        def checked_load_indirect(address):
+            value = load_indirect(address)
+            if address < linear:
+                cell = cells[address]
+                if flags[cell] & READ:
+                    trip(cell, READ, value)
+            return value
+
+        def checked_store_indirect(address, value):
+            if address < linear:
+                cell = cells[address]
+                if flags[cell] & WRITE:
+                    trip(cell, WRITE, value & 0xFF)
+            store_indirect(address, value)
+
+        pic.load, pic.store = checked_load, checked_store
+        pic.load_indirect, pic.store_indirect = checked_load_indirect, checked_store_indirect
+
+        pic.sync_status()
+        self.values = {cell: mem[cell] for cell, watches in self.watches.items()
+                       if any(w.mode == 'change' for w in watches)}
+
+    def detach(self):
+        del self.pic.load, self.pic.store, self.pic.load_indirect, self.pic.store_indirect
+
+    def stopped(self, pic):
+        ''' until test of a checked run.  true once a watch has tripped or pc is at a
+        conditional breakpoint whose condition is met '''
+        if self.values:
+            if pic.alu:
+                pic.sync_status()
+            mem = pic.mem
+            for cell, last in self.values.items():
+                if mem[cell] != last:
+                    self.values[cell] = mem[cell]
+                    self.trip(cell, CHANGE, mem[cell])
+        if self.hit is not None:
+            return True
+        condition = self.conditions.get(pic.pc)
+        return condition is not None and bool(condition(pic))
+
+    def run(self, compiled=False, max_cycles=None, max_instructions=None, timeout=None):
+        ''' run until a breakpoint or watch stops it, or as Pic.simulate does, and return a
+        Stop.  a run started at a breakpoint runs on past it.  watches and conditional
+        breakpoints are checked after every instruction so they single step the run '''
+        pic = self.pic
+        watching = bool(self.watches)
+        self.conditions = {a: c for a, c in self.breakpoints.items() if c is not None}
+        checked = watching or bool(self.conditions)
+
+        self.hit = None
+        if watching:
+            self.attach()
+        try:
+            result = pic.simulate(compiled=compiled and not checked, max_cycles=max_cycles,
+                                  max_instructions=max_instructions, timeout=timeout,
+                                  stop_at=[a for a, c in self.breakpoints.items() if c is None],
+                                  until=self.stopped if checked else None)
+        finally:
+            if watching:
+                self.detach()
+
+        reason = result.reason
+        if reason == 'address':
+            reason = 'breakpoint'
+        elif reason == 'until':
+            reason = 'breakpoint' if self.hit is None else 'watch'
+
+        return Stop(reason, pic.pc, self.hit, result.cycles, result.instructions,
+                    result.elapsed, pic.snapshot())
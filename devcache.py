@@ -0,0 +1,62 @@
+'''
+on disk cache of the tables a Decoder builds.
+
+parsing the instruction table and the register definitions of the .inc file is redone by
+every new process.  instead the finished tables are pickled into __pycache__ next to the .inc
+file, keyed by a hash of the .inc file, the instruction table, the source of the module that
+builds them and VERSION, so editing the decoder can't leave stale tables behind.  a Decoder
+whose key matches loads them in one read.  any other key, or a cache that is missing, unreadable or
+can't be written, just means building the tables the slow way.
+
+bump VERSION whenever the tables a Decoder caches change shape.
+'''
+
+import os
+import pickle
+import hashlib
+
+VERSION = 1
+
+
+def key(ins_data, inc_file, sources=()):
+    ''' hash of everything the cached tables are built from, sources being the files of the code
+    building them '''
+    h = hashlib.sha1()
+    h.update(repr((VERSION, tuple(ins_data))).encode())
+    for filename in (inc_file,) + tuple(sources):
+        with open(filename, 'rb') as fp:
+            h.update(fp.read())
+    return h.hexdigest()
+
+
+def path(inc_file):
+    ''' cache file for the tables built from inc_file '''
+    directory, name = os.path.split(os.path.abspath(inc_file))
+    return os.path.join(directory, '__pycache__', name + '.pickle')
+
+
+def load(inc_file, digest):
+    ''' cached tables for digest or None '''
+    try:
+        with open(path(inc_file), 'rb') as fp:
+            cached, tables = pickle.load(fp)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError,
+            ValueError):
+        return None
+    return tables if cached == digest else None
+
+
+def save(inc_file, digest, tables):
+    ''' write the tables to the cache, quietly giving up if it can't be written '''
+    filename = path(inc_file)
+    temp = '{}.{}'.format(filename, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(temp, 'wb') as fp:
+            pickle.dump((digest, tables), fp, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, filename)
+    except OSError:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
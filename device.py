@@ -0,0 +1,66 @@
+'''
+memory sizes and layout of the enhanced midrange parts the simulator can model.
+
+a Device gives the words of program flash, the number of data memory banks, the bytes of
+general purpose ram including the 16 bytes of common ram, the depth of the return stack and
+the word addresses of the configuration words.  every bank holds 0x50 bytes of gpr above its
+SFRs so the linear (0x2000) view of gpr runs to 0x2000 + (banks - 1) * 0x50.  only the first
+gpr bytes of it have memory behind them.
+
+only parts with the 16F1826 register file are supported, the 16F1826 and 16F1827 in PARTS.
+the special function registers come from the .inc file the Decoder is built from, not from
+the Device, and the larger 8K to 32K parts have a different register file.  a part with
+another register file needs its own .inc for the Decoder and a Device built for it, which get
+passes straight through.  the stack depth has to be a power of two as push and pop wrap the
+stack pointer with a mask.
+
+profiles are kept as plain tuples in PARTS and a Device is only built when get asks for it.
+the Pic, its DataMem and the hex loader size their arrays and address maps from the Device.
+DataMem builds its address map once per memory layout and shares it between instances.
+'''
+
+import collections
+
+# part used when none is asked for
+DEFAULT = '16F1826'
+
+# rom, banks, gpr, stack and config by part name
+PARTS = {
+    '16F1826': (0x0800, 32, 0x100, 16, (0x8007, 0x8008)),
+    '16F1827': (0x1000, 32, 0x180, 16, (0x8007, 0x8008)),
+}
+
+# built devices by part name
+_devices = {}
+
+
+class Device(collections.namedtuple('Device', 'name rom banks gpr stack config')):
+    __slots__ = ()
+
+    def __new__(cls, name, rom, banks, gpr, stack, config):
+        if stack < 1 or stack & (stack - 1):
+            raise ValueError('stack depth {} of {} is not a power of two'.format(stack, name))
+        return super().__new__(cls, name, rom, banks, gpr, stack, config)
+
+    @property
+    def ram(self):
+        ''' end of the traditional banked addresses '''
+        return self.banks * 0x80
+
+    @property
+    def linear(self):
+        ''' end of the linear gpr addresses '''
+        return 0x2000 + (self.banks - 1) * 0x50
+
+
+def get(part=None):
+    ''' the Device of a part name, DEFAULT if none.  a Device is passed back as it is '''
+    if isinstance(part, Device):
+        return part
+    name = (part or DEFAULT).upper()
+    name = name[3:] if name.startswith('PIC') else name
+    if name not in _devices:
+        if name not in PARTS:
+            raise ValueError('unknown part {}'.format(part))
+        _devices[name] = Device(name, *PARTS[name])
+    return _devices[name]
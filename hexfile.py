@@ -0,0 +1,124 @@
+'''
+intel hex loader for 14 bit Pic images.
+
+a hex file addresses bytes, two per program word, low byte first.  word addresses below 0x8000
+are program memory, 0x8000 up are the configuration words (user id, device id, config 1 and
+2 at 0x8007 and 0x8008) and 0xF000 up the eeprom data, one eeprom byte in the low byte of each
+word.
+
+each record is unhexlified in one call and checked by summing its bytes.  data records are
+copied into the images a slice at a time.  record types 00 (data), 01 (end of file),
+02 (extended segment address) and 04 (extended linear address) are handled.  any other record,
+start address records (03, 05) included, is an error naming its line rather than something
+skipped without a word.
+'''
+
+import os
+import sys
+import mmap
+import array
+import binascii
+import collections
+
+# word addresses where configuration and eeprom data start and the end of the address space
+CONFIG = 0x8000
+EEPROM = 0xF000
+END = 0x10000
+
+# value of an unprogrammed program word
+ERASED = 0x3FFF
+
+# program is an array('H') of words from address 0 up to the highest one loaded, config a dict
+# of configuration words by word address and eeprom a bytearray from eeprom address 0
+HexImage = collections.namedtuple('HexImage', 'program config eeprom')
+
+
+def read(source):
+    ''' load a hex image from a file name, bytes or an mmap '''
+    if isinstance(source, str):
+        with open(source, 'rb') as fp:
+            # an empty file can't be mapped
+            if not os.fstat(fp.fileno()).st_size:
+                return parse(b'')
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return parse(data)
+    return parse(source)
+
+
+def lines(data):
+    ''' the lines of data, each sliced out on its own so an mmap is never copied whole '''
+    start, size = 0, len(data)
+    while start < size:
+        end = data.find(b'\n', start)
+        if end < 0:
+            end = size
+        yield data[start:end]
+        start = end + 1
+
+
+def parse(data):
+    ''' parse the text of a hex file held in bytes, bytearray, mmap or str.  an mmap is read
+    a line at a time where it is '''
+    if isinstance(data, str):
+        data = data.encode('ascii')
+    elif not hasattr(data, 'find'):
+        data = bytes(data)
+
+    program = bytearray(ERASED.to_bytes(2, 'little') * CONFIG)
+    config = bytearray(ERASED.to_bytes(2, 'little') * (EEPROM - CONFIG))
+    eeprom = bytearray(b'\xff' * 2 * (END - EEPROM))
+    written = set()
+    top = eetop = 0
+
+    base = 0
+    for number, line in enumerate(lines(data), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(b':'):
+            raise ValueError('line {}: record does not start with a colon'.format(number))
+        try:
+            record = binascii.unhexlify(line[1:])
+        except binascii.Error as e:
+            raise ValueError('line {}: {}'.format(number, e))
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise ValueError('line {}: record length does not match its count'.format(number))
+        if sum(record) & 0xFF:
+            raise ValueError('line {}: bad checksum'.format(number))
+
+        rectype = record[3]
+        payload = record[4:-1]
+        if rectype == 0x00:
+            address = base + ((record[1] << 8) | record[2])
+            end = address + len(payload)
+            if end > 2 * END:
+                raise ValueError('line {}: data beyond word address 0xFFFF'.format(number))
+
+            # copy the parts of the record falling in each region
+            for start, stop, image in ((0, CONFIG, program), (CONFIG, EEPROM, config),
+                                       (EEPROM, END, eeprom)):
+                lo, hi = max(address, 2 * start), min(end, 2 * stop)
+                if lo < hi:
+                    image[lo - 2 * start:hi - 2 * start] = payload[lo - address:hi - address]
+                    if image is program:
+                        top = max(top, hi)
+                    elif image is config:
+                        written.update(range(lo // 2, (hi + 1) // 2))
+                    else:
+                        eetop = max(eetop, hi - 2 * start)
+        elif rectype == 0x01:
+            break
+        elif rectype == 0x02:
+            base = int.from_bytes(payload, 'big') << 4
+        elif rectype == 0x04:
+            base = int.from_bytes(payload, 'big') << 16
+        else:
+            raise ValueError('line {}: unsupported record type {:02X}'.format(number, rectype))
+
+    words = array.array('H', bytes(program[:top + (top & 1)]))
+    if sys.byteorder == 'big':
+        words.byteswap()
+
+    config = {a: config[2 * (a - CONFIG)] | (config[2 * (a - CONFIG) + 1] << 8)
+              for a in sorted(written)}
+    return HexImage(words, config, eeprom[:eetop + (eetop & 1):2])
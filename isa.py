@@ -0,0 +1,32 @@
+'''
+instruction set facts shared by the modules that look at a program rather than run it: the
+block compiler, loop detection, lockstep and the static analysis.
+'''
+
+# instructions reading or writing data memory through an FSR, which can reach PCL
+INDIRECT = {'MOVIW', 'MOVWI'}
+
+# instructions that may skip the next instruction
+SKIPS = {'DECFSZ', 'INCFSZ', 'BTFSC', 'BTFSS'}
+
+# instructions that leave a routine
+RETURNS = {'RETURN', 'RETLW', 'RETFIE'}
+
+# instructions writing f whatever their d bit.  the rest write f only when d is 1
+WRITES = {'MOVWF', 'CLRF', 'BCF', 'BSF'}
+
+# file register addresses of core registers in every bank
+INDF0 = 0x00
+INDF1 = 0x01
+PCL = 0x02
+STATUS = 0x03
+BSR = 0x08
+PCLATH = 0x0A
+
+# highest file register address of the core registers mirrored in every bank
+CORE = 0x0B
+
+
+def writes(ins):
+    ''' True if ins writes its f '''
+    return ins.info.mnemonic in WRITES or ins.d == 1
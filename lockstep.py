@@ -0,0 +1,508 @@
+'''
+run many copies of one program in lockstep with numpy.
+
+every instance has its own row of data memory, stack, program counter and cycle count held in
+numpy arrays.  each step picks the lowest program counter of the instances still running and
+runs that instruction once for every instance sitting there, as array operations over their
+rows.  instances that branched elsewhere wait until the lowest program counter reaches them so
+paths that split on a skip or branch join up again at the first address they share.  when
+every instance follows the same path an instruction costs a handful of array operations
+however many instances there are.
+
+the instructions mirror the Pic handlers exactly, including the quirks of the simple model,
+so an instance ends up in the same state a Pic running the same inputs would.  flags are
+written to STATUS straight away rather than deferred.  the instance rows share the cell layout
+of the Pic the program was loaded into so registers are read and written by name or address.
+
+numpy is needed for this module only.
+'''
+
+import array
+
+import numpy as np
+
+import pic
+import isa
+
+# stop reasons by code in Lockstep.reason.  unsupported instances stopped at an instruction
+# lockstep can't run, e.g. RESET, and can be carried on with in a Pic after export
+REASONS = ('running', 'halt', 'idle', 'cycles', 'unsupported')
+RUNNING, HALT, IDLE, CYCLES, UNSUPPORTED = range(len(REASONS))
+
+
+class Lockstep:
+    ''' n instances of the program loaded in a Pic, starting from that Pic's state '''
+
+    def __init__(self, p, n):
+        self.pic = p
+        self.n = n
+
+        p.sync_status()
+        self.mem = np.tile(np.frombuffer(p.mem, np.uint8), (n, 1))
+        self.stack = np.tile(np.frombuffer(p.stack, np.uint16).astype(np.int64), (n, 1))
+        self.pc = np.full(n, p.pc, np.int64)
+        self.cycles = np.zeros(n, np.uint64)
+        self.instructions = np.zeros(n, np.uint64)
+        self.reason = np.zeros(n, np.uint8)
+
+        # cycles spent at each program address summed over every instance
+        self.profile = np.zeros(len(p.words), np.uint64)
+
+        self.map = np.array(p.map, np.intp)
+        self.linear = p.data.linear
+        self.cell_pcl = p.cell_pcl
+        self.cell_status = p.cell_status
+        self.cell_bsr = p.cell_bsr
+        self.cell_wreg = p.cell_wreg
+        self.cell_pclath = p.cell_pclath
+        self.cell_stkptr = p.cell_stkptr
+        self.cell_fsr = ((p.cell_fsr0l, p.cell_fsr0h), (p.cell_fsr1l, p.cell_fsr1h))
+        self.mask_c = p.mask_c
+        self.mask_dc = p.mask_dc
+        self.mask_z = p.mask_z
+
+        # low byte of each program word for indirect reads of program memory
+        self.rom = np.frombuffer(p.words, np.uint16).astype(np.int64) & 0xFF
+
+        # (handler, instruction, base cycles, may touch PCL) by address, built on first use
+        self.ops = {}
+
+    def cell(self, register):
+        ''' data memory cell of a register name or address '''
+        if isinstance(register, str):
+            register = self.pic.core.reg[register]
+        return self.pic.map[register]
+
+    def read(self, register):
+        ''' array of the value of a register in every instance '''
+        self.mem[:, self.cell_pcl] = self.pc & 0xFF
+        return self.mem[:, self.cell(register)].copy()
+
+    def write(self, register, values):
+        ''' set a register in every instance from a value or an array of n values '''
+        self.mem[:, self.cell(register)] = np.asarray(values) & 0xFF
+
+    def export(self, i, p=None):
+        ''' copy the state of instance i into a Pic, by default the one it started from '''
+        p = p or self.pic
+        self.mem[i, self.cell_pcl] = self.pc[i] & 0xFF
+        p.mem[:] = self.mem[i].tobytes()
+        p.data.mark()
+        p.alu = None
+        p.stack[:] = array.array('H', self.stack[i].astype(np.uint16).tobytes())
+        p.pc = int(self.pc[i])
+        p.cycle_count = int(self.cycles[i])
+        p.instruction_count = int(self.instructions[i])
+        p.idle = self.reason[i] == IDLE
+        return p
+
+    def run(self, max_cycles=None):
+        ''' run until every instance halts, goes idle, has run max_cycles or reaches an
+        unsupported instruction.  returns the array of stop reason codes, indexes into
+        REASONS '''
+        reason, pc = self.reason, self.pc
+        reason[(reason == RUNNING) & ((pc == pic.HALT) | (pc >= len(self.rom)))] = HALT
+        if max_cycles is not None:
+            reason[(reason == RUNNING) & (self.cycles >= max_cycles)] = CYCLES
+
+        running = reason == RUNNING
+        while running.any():
+            address = pc[running].min()
+            rows = np.flatnonzero(running & (pc == address))
+            self.step(address, rows)
+
+            stopped = (pc[rows] == pic.HALT) | (pc[rows] >= len(self.rom))
+            reason[rows[stopped]] = HALT
+            if max_cycles is not None:
+                over = (self.cycles[rows] >= max_cycles) & (reason[rows] == RUNNING)
+                reason[rows[over]] = CYCLES
+            running = reason == RUNNING
+        return reason
+
+    def step(self, address, rows):
+        ''' run the instruction at address for the instances in rows '''
+        op = self.ops.get(address)
+        if op is None:
+            op = self.ops[address] = self.resolve(address)
+        handler, ins, cycles, touches_pcl = op
+        if handler is None:
+            self.reason[rows] = UNSUPPORTED
+            return
+
+        self.pc[rows] = address + 1
+        self.cycles[rows] += cycles
+        self.instructions[rows] += 1
+        self.profile[address] += cycles * len(rows)
+        if touches_pcl:
+            self.mem[rows, self.cell_pcl] = (address + 1) & 0xFF
+
+        self.address = address
+        handler(rows, ins)
+
+    def resolve(self, address):
+        ''' handler record for the instruction at address.  the handler is None for an
+        instruction lockstep doesn't support '''
+        ins = self.pic.instruction(address)
+        if ins is None:
+            raise self.pic.no_instruction(address)
+        handler = getattr(self, '_' + ins.info.handler, None)
+        touches_pcl = ins.f == isa.PCL or ins.info.mnemonic in isa.INDIRECT
+        return handler, ins, ins.info.base_cycles, touches_pcl
+
+    def skip(self, rows, taken):
+        ''' skip the next instruction for the rows where taken is True '''
+        rows = rows[taken]
+        self.pc[rows] += 1
+        self.cycles[rows] += 1
+        self.profile[self.address] += len(rows)
+
+    def cells(self, rows, f):
+        ''' data memory cells of banked file register f for each of rows '''
+        bsr = self.mem[rows, self.cell_bsr].astype(np.intp)
+        return self.map[(bsr << 7) | f]
+
+    def load(self, rows, f):
+        return self.mem[rows, self.cells(rows, f)].astype(np.int64)
+
+    def store(self, rows, f, values):
+        cells = self.cells(rows, f)
+        self.mem[rows, cells] = values & 0xFF
+        if f == isa.PCL:
+            self.pc[rows] = (self.pc[rows] & ~0xFF) | self.mem[rows, self.cell_pcl]
+
+    def load_indirect(self, rows, address):
+        values = np.zeros(len(rows), np.int64)
+        rom = (address >= 0x8000) & (address < 0x8000 + len(self.rom))
+        values[rom] = self.rom[address[rom] - 0x8000]
+        data = address < self.linear
+        values[data] = self.mem[rows[data], self.map[address[data]]]
+        return values
+
+    def store_indirect(self, rows, address, values):
+        data = address < self.linear
+        rows, cells = rows[data], self.map[address[data]]
+        self.mem[rows, cells] = values[data] & 0xFF
+        if (cells == self.cell_pcl).any():
+            self.pc[rows] = (self.pc[rows] & ~0xFF) | self.mem[rows, self.cell_pcl]
+
+    def get_w(self, rows):
+        return self.mem[rows, self.cell_wreg].astype(np.int64)
+
+    def set_w(self, rows, values):
+        self.mem[rows, self.cell_wreg] = values & 0xFF
+
+    def get_fsr(self, rows, n):
+        low, high = self.cell_fsr[n]
+        return (self.mem[rows, high].astype(np.int64) << 8) | self.mem[rows, low]
+
+    def set_fsr(self, rows, n, values):
+        low, high = self.cell_fsr[n]
+        values = values % 0x10000
+        self.mem[rows, high] = values >> 8
+        self.mem[rows, low] = values & 0xFF
+
+    def get_c(self, rows):
+        return (self.mem[rows, self.cell_status] & self.mask_c != 0).astype(np.int64)
+
+    def set_bit(self, rows, cell, mask, values):
+        ''' set or clear mask in cell for each of rows by the truth of values '''
+        old = self.mem[rows, cell]
+        self.mem[rows, cell] = np.where(values, old | mask, old & (0xFF ^ mask))
+
+    def set_z(self, rows, values):
+        self.set_bit(rows, self.cell_status, self.mask_z, values & 0xFF == 0)
+
+    def set_c(self, rows, values):
+        self.set_bit(rows, self.cell_status, self.mask_c, values)
+
+    def set_arithmetic(self, rows, a, b, carry, v):
+        ''' C, DC and Z of an add the way Pic.sync_status works them out '''
+        status = self.mem[rows, self.cell_status] & (0xFF ^ (self.mask_c | self.mask_dc |
+                                                              self.mask_z))
+        status = np.where(v & 0x100, status | self.mask_c, status)
+        status = np.where(((a & 0x0F) + (b & 0x0F) + carry) & 0x10, status | self.mask_dc, status)
+        status = np.where(v & 0xFF, status, status | self.mask_z)
+        self.mem[rows, self.cell_status] = status
+
+    def set_register(self, rows, name, bit, state):
+        cell = self.cell(name)
+        mask = 1 << self.pic.core.reg[bit]
+        self.set_bit(rows, cell, mask, np.full(len(rows), state))
+
+    def result(self, rows, ins, v):
+        ''' write v to W or f by the d bit '''
+        if ins.d == 0:
+            self.set_w(rows, v)
+        else:
+            self.store(rows, ins.f, v)
+
+    def push(self, rows):
+        sp = self.mem[rows, self.cell_stkptr].astype(np.int64)
+        top = self.stack.shape[1] - 1
+        overflow = sp == top
+        if overflow.any():
+            self.set_register(rows[overflow], 'PCON', 'STKOVR', 1)
+        sp = (sp + 1) & top
+        self.stack[rows, sp] = self.pc[rows]
+        self.mem[rows, self.cell_stkptr] = sp
+
+    def pop(self, rows):
+        sp = self.mem[rows, self.cell_stkptr].astype(np.int64)
+        underflow = sp == 0
+        if underflow.any():
+            self.set_register(rows[underflow], 'PCON', 'STKUNF', 1)
+        self.pc[rows] = self.stack[rows, sp]
+        self.mem[rows, self.cell_stkptr] = (sp - 1) & (self.stack.shape[1] - 1)
+
+    def idle(self, rows):
+        ''' instances in rows that jumped to the address they were at go idle '''
+        rows = rows[self.pc[rows] == self.address]
+        self.reason[rows] = IDLE
+
+    # opcode implementations, one call covering every instance at the same address
+    def _addfsr(self, rows, ins):
+        self.set_fsr(rows, ins.n, self.get_fsr(rows, ins.n) + pic.twos_complement(ins.k, 6))
+
+    def _addlw(self, rows, ins):
+        w = self.get_w(rows)
+        v = w + ins.k
+        self.set_w(rows, v)
+        self.set_arithmetic(rows, w, ins.k, 0, v)
+
+    def _addwf(self, rows, ins):
+        x = self.load(rows, ins.f)
+        w = self.get_w(rows)
+        v = x + w
+        self.result(rows, ins, v)
+        self.set_arithmetic(rows, x, w, 0, v)
+
+    def _addwfc(self, rows, ins):
+        x = self.load(rows, ins.f)
+        w = self.get_w(rows)
+        c = self.get_c(rows)
+        v = x + w + c
+        self.result(rows, ins, v)
+        self.set_arithmetic(rows, x, w, c, v)
+
+    def _andlw(self, rows, ins):
+        v = self.get_w(rows) & ins.k
+        self.set_w(rows, v)
+        self.set_z(rows, v)
+
+    def _andwf(self, rows, ins):
+        v = self.load(rows, ins.f) & self.get_w(rows)
+        self.result(rows, ins, v)
+        self.set_z(rows, v)
+
+    def _asrf(self, rows, ins):
+        v = self.load(rows, ins.f)
+        self.set_c(rows, v & 0x01)
+        v = (v >> 1) | (v & 0x80)
+        self.set_z(rows, v)
+        self.result(rows, ins, v)
+
+    def _bcf(self, rows, ins):
+        self.store(rows, ins.f, self.load(rows, ins.f) & ~(1 << ins.b))
+
+    def _bra(self, rows, ins):
+        self.pc[rows] += pic.twos_complement(ins.k, 9)
+        self.idle(rows)
+
+    def _brw(self, rows, ins):
+        self.pc[rows] += self.get_w(rows)
+
+    def _bsf(self, rows, ins):
+        self.store(rows, ins.f, self.load(rows, ins.f) | (1 << ins.b))
+
+    def _btfsc(self, rows, ins):
+        self.skip(rows, self.load(rows, ins.f) & (1 << ins.b) == 0)
+
+    def _btfss(self, rows, ins):
+        self.skip(rows, self.load(rows, ins.f) & (1 << ins.b) != 0)
+
+    def _call(self, rows, ins):
+        self.push(rows)
+        pclath = self.mem[rows, self.cell_pclath].astype(np.int64)
+        self.pc[rows] = ((pclath & 0b01111000) << 8) | ins.k
+
+    def _callw(self, rows, ins):
+        self.push(rows)
+        pclath = self.mem[rows, self.cell_pclath].astype(np.int64)
+        self.pc[rows] = ((pclath & 0b01111111) << 8) | self.get_w(rows)
+
+    def _clrf(self, rows, ins):
+        self.store(rows, ins.f, np.zeros(len(rows), np.int64))
+        self.set_z(rows, 0)
+
+    def _clrw(self, rows, ins):
+        self.set_w(rows, 0)
+        self.set_z(rows, 0)
+
+    def _clrwdt(self, rows, ins):
+        pass
+
+    def _comf(self, rows, ins):
+        v = ~self.load(rows, ins.f) & 0xFF
+        self.result(rows, ins, v)
+        self.set_z(rows, v)
+
+    def _decf(self, rows, ins):
+        v = (self.load(rows, ins.f) - 1) & 0xFF
+        self.result(rows, ins, v)
+        self.set_z(rows, v)
+
+    def _decfsz(self, rows, ins):
+        v = (self.load(rows, ins.f) - 1) & 0xFF
+        self.result(rows, ins, v)
+        self.skip(rows, v == 0)
+
+    def _goto(self, rows, ins):
+        pclath = self.mem[rows, self.cell_pclath].astype(np.int64)
+        self.pc[rows] = ((pclath & 0b01111000) << 8) | ins.k
+        self.idle(rows)
+
+    def _incf(self, rows, ins):
+        v = (self.load(rows, ins.f) + 1) & 0xFF
+        self.result(rows, ins, v)
+        self.set_z(rows, v)
+
+    def _incfsz(self, rows, ins):
+        v = (self.load(rows, ins.f) + 1) & 0xFF
+        self.result(rows, ins, v)
+        self.skip(rows, v == 0)
+
+    def _iorlw(self, rows, ins):
+        v = self.get_w(rows) | ins.k
+        self.set_w(rows, v)
+        self.set_z(rows, v)
+
+    def _iorwf(self, rows, ins):
+        v = self.load(rows, ins.f) | self.get_w(rows)
+        self.result(rows, ins, v)
+        self.set_z(rows, v)
+
+    def _lslf(self, rows, ins):
+        v = self.load(rows, ins.f)
+        self.result(rows, ins, v << 1)
+        self.set_c(rows, v & 0x80)
+        self.set_z(rows, v & 0x7F)
+
+    def _lsrf(self, rows, ins):
+        v = self.load(rows, ins.f)
+        self.result(rows, ins, v >> 1)
+        self.set_c(rows, v & 0x01)
+        self.set_z(rows, v & 0xFE)
+
+    def _movf(self, rows, ins):
+        v = self.load(rows, ins.f)
+        self.result(rows, ins, v)
+        self.set_z(rows, v)
+
+    def _moviwk(self, rows, ins):
+        a = (self.get_fsr(rows, ins.n) + pic.twos_complement(ins.k, 6)) & 0xFFFF
+        v = self.load_indirect(rows, a)
+        self.set_w(rows, v)
+        self.set_z(rows, v)
+
+    def _moviwm(self, rows, ins):
+        m = ins.m
+        a = self.get_fsr(rows, ins.n) + (1 if m == 0 else -1 if m == 1 else 0)
+        v = self.load_indirect(rows, a & 0xFFFF)
+        self.set_w(rows, v)
+        self.set_z(rows, v)
+        self.set_fsr(rows, ins.n, a + (1 if m == 2 else -1 if m == 3 else 0))
+
+    def _movlb(self, rows, ins):
+        self.mem[rows, self.cell_bsr] = ins.k
+
+    def _movlp(self, rows, ins):
+        self.mem[rows, self.cell_pclath] = ins.k
+
+    def _movlw(self, rows, ins):
+        self.set_w(rows, ins.k)
+
+    def _movwf(self, rows, ins):
+        self.store(rows, ins.f, self.get_w(rows))
+
+    def _movwik(self, rows, ins):
+        a = (self.get_fsr(rows, ins.n) + pic.twos_complement(ins.k, 6)) & 0xFFFF
+        self.store_indirect(rows, a, self.get_w(rows))
+
+    def _movwim(self, rows, ins):
+        m = ins.m
+        a = self.get_fsr(rows, ins.n) + (1 if m == 0 else -1 if m == 1 else 0)
+        self.store_indirect(rows, a & 0xFFFF, self.get_w(rows))
+        self.set_fsr(rows, ins.n, a + (1 if m == 2 else -1 if m == 3 else 0))
+
+    def _nop(self, rows, ins):
+        pass
+
+    def _option(self, rows, ins):
+        self.mem[rows, self.cell('OPTION_REG')] = self.mem[rows, self.cell_wreg]
+
+    def _retfie(self, rows, ins):
+        self.pop(rows)
+        self.set_register(rows, 'INTCON', 'GIE', 1)
+
+    def _retlw(self, rows, ins):
+        self.set_w(rows, ins.k)
+        self.pop(rows)
+
+    def _return(self, rows, ins):
+        self.pop(rows)
+
+    def _rlf(self, rows, ins):
+        v = self.load(rows, ins.f)
+        self.result(rows, ins, (v << 1) | self.get_c(rows))
+        self.set_c(rows, v & 0x80)
+
+    def _rrf(self, rows, ins):
+        v = self.load(rows, ins.f)
+        self.result(rows, ins, (self.get_c(rows) << 7) | (v >> 1))
+        self.set_c(rows, v & 0x01)
+
+    def _sleep(self, rows, ins):
+        self.set_register(rows, 'STATUS', 'NOT_TO', 1)
+        self.set_register(rows, 'STATUS', 'NOT_PD', 0)
+        self.reason[rows] = IDLE
+
+    def _sublw(self, rows, ins):
+        w = -self.get_w(rows) & 0xFF
+        v = w + ins.k
+        self.set_w(rows, v)
+        self.set_arithmetic(rows, w, ins.k, 0, v)
+
+    def _subwf(self, rows, ins):
+        x = self.load(rows, ins.f)
+        w = -self.get_w(rows) & 0xFF
+        v = w + x
+        self.result(rows, ins, v)
+        self.set_arithmetic(rows, w, x, 0, v)
+
+    def _subwfb(self, rows, ins):
+        x = self.load(rows, ins.f)
+        w = -self.get_w(rows) & 0xFF
+        borrow = 1 - self.get_c(rows)
+        v = x + w - borrow
+        self.result(rows, ins, v)
+        self.set_arithmetic(rows, x, w, borrow, v)
+
+    def _swapf(self, rows, ins):
+        v = self.load(rows, ins.f)
+        self.result(rows, ins, (v << 4) & 0xFF | (v >> 4))
+
+    def _tris(self, rows, ins):
+        if ins.f == 0b101:
+            self.mem[rows, self.cell('TRISA')] = self.mem[rows, self.cell_wreg]
+        elif ins.f == 0b110:
+            self.mem[rows, self.cell('TRISB')] = self.mem[rows, self.cell_wreg]
+
+    def _xorlw(self, rows, ins):
+        v = self.get_w(rows) ^ ins.k
+        self.set_w(rows, v)
+        self.set_z(rows, v)
+
+    def _xorwf(self, rows, ins):
+        v = self.load(rows, ins.f) ^ self.get_w(rows)
+        self.result(rows, ins, v)
+        self.set_z(rows, v)
@@ -0,0 +1,314 @@
+'''
+fast forward of counted loops.
+
+delay loops are built from a DECFSZ or INCFSZ on a counter followed by a GOTO or BRA back to
+the top of the loop:
+
+    loop    ...
+            decfsz  count, f
+            bra     loop
+
+when such a loop's body leaves the machine in the same state each time round apart from the
+counter, every remaining iteration does exactly what the last one did.  the loop is watched
+at runtime for that, but only over what an iteration can touch.  the first time the branch
+back lands on a top of loop, every path from there to the branch is followed through the
+code, into the routines it calls, for the instructions an iteration can run and the cells of
+data memory they can write.  a body that can't be followed, e.g. a computed jump, indirect
+access, a return out of the loop or another instruction touching the counter, is left to run
+normally.  a sample taken at the branch is then those cells, the stack and the cycles of those
+instructions, so its cost is set by the size of the body, not of the part.
+
+when a sample matches an earlier one apart from the counter, and the counter moved by exactly
+the number of branches in between, those iterations repeat for as long as the counter lasts.
+the repeats are skipped at once, leaving the last iteration and any odd few to run normally:
+the per address cycles added between the samples are multiplied up and credited to the
+profile and the counter is stepped on.  a sample that doesn't match is kept to compare the
+next one with, and a loop with only a few iterations left isn't sampled at all.
+
+nested loops fall out of this.  an inner loop is fast forwarded inside each iteration of the
+outer loop, and once two outer iterations match the outer loop is fast forwarded too.
+
+Pic.fast_loops is the switch for all of this.  anything that has to see every iteration of a
+loop, not just its effect, clears it for as long as it needs to and puts back the value it
+found: Pic.simulate for verbose, traced and stop_at or until runs, and so the Debugger with
+any breakpoint or watch set.  code doing the same must follow suit.  Pic.fast_calls is used
+the same way by code that only has to see every call, a callprof.Profiler while it is
+attached, and only stops loops whose body calls a routine.  a bounded run with only cycle or
+instruction limits keeps both, a fast forward never goes past either limit.
+
+firmware that has nothing left to do parks in a jump to itself (GOTO $ or BRA -1).  nothing
+but an interrupt or a peripheral can get it out of one, so the jump is wrapped to mark the Pic
+idle the moment it lands back on itself and the run stops there.
+'''
+
+import operator
+import collections
+
+import isa
+
+# most loop branches to let pass before sampling again after a failed match.  a sample is
+# compared with the one before it by how far the counter moved, so less than a full turn
+MAXBACKOFF = 0x80
+
+# fewest iterations that must be left for sampling a loop to pay for itself
+MINREMAINING = 8
+
+# most addresses an iteration may run before the loop is left to run normally
+MAXBODY = 0x100
+
+# instructions an iteration can't be followed through, or repeated without running them
+STOPS = isa.INDIRECT | {'BRW', 'CALLW', 'RESET', 'SLEEP', 'MOVLP', 'TRIS', 'OPTION'}
+
+# what an iteration can run from a given top of loop.  addresses, a sorted tuple, and
+# profile, returning their cycles, cover every instruction it can run.  state returns the
+# cells of data memory it can write, other than the counter, and calls is True if it calls
+# a routine
+Body = collections.namedtuple('Body', 'addresses profile state calls')
+
+
+class CountedLoop:
+    ''' wraps the handler of the branch at the bottom of a counted loop '''
+
+    def __init__(self, pic, address, handler):
+        self.pic = pic
+        self.address = address
+        self.handler = handler
+
+        # DECFSZ or INCFSZ just before the branch
+        self.counter = pic.ops[address - 1][1]
+        self.step = -1 if self.counter.info.mnemonic == 'DECFSZ' else 1
+
+        # Body, or None if the loop can't be forwarded, by (top, PCLATH page, BSR)
+        self.bodies = {}
+
+        # times the branch has been taken
+        self.taken = 0
+
+        self.reset()
+
+    def reset(self):
+        ''' forget any partly measured iteration '''
+        # state, counter, profile, counts and taken the last time the loop was sampled
+        self.start = None
+
+        # branches left to let pass before sampling again
+        self.backoff = 0
+        self.wait = 0
+
+    def __call__(self, ins):
+        self.handler(ins)
+
+        pic = self.pic
+        self.taken += 1
+        if not pic.fast_loops:
+            return
+        if self.wait:
+            self.wait -= 1
+            return
+
+        mem = pic.mem
+        cell = pic.map[(mem[pic.cell_bsr] << 7) | self.counter.f]
+        value = mem[cell]
+        if (value - 1 if self.step < 0 else 0xFF - value) < MINREMAINING:
+            self.start = None
+            return
+
+        key = pic.pc, pic.pclath & 0x78, mem[pic.cell_bsr]
+        body = self.bodies.get(key, False)
+        if body is False:
+            body = self.bodies[key] = self.follow(*key)
+        if body is None or body.calls and not pic.fast_calls or cell == pic.cell_stkptr:
+            return
+
+        pic.sync_status()
+        sample = ((body.state(mem), pic.stack.tobytes(), pic.pch), value,
+                  body.profile(pic.cycles), pic.cycle_count, pic.instruction_count, self.taken)
+        start = self.start
+        if start is not None and start[0] == sample[0] and self.forward(cell, body, start):
+            self.start = None
+            self.backoff = 0
+        else:
+            # not settled yet.  compare the next sample with this one but back off if it
+            # keeps failing
+            if start is not None:
+                self.backoff = min(MAXBACKOFF, self.backoff * 2 or 1)
+                self.wait = self.backoff
+            self.start = sample
+
+    def follow(self, top, page, bsr):
+        ''' the Body of an iteration starting at top, None if the loop isn't self contained.
+        every path from top is followed to the branch, through the routines it calls.  paths
+        that stop the run, at an erased or invalid word or off the end of program memory,
+        never come back to the branch so they are left out '''
+        pic = self.pic
+        f = self.counter.f
+        if f <= isa.CORE:
+            return None
+
+        seen = set()
+        todo = [(top, False)]
+        written = set()
+        banked = calls = False
+        while todo:
+            item = todo.pop()
+            a, routine = item
+            if item in seen or a == self.address or not 0 <= a < len(pic.words):
+                continue
+            seen.add(item)
+            if len(seen) > MAXBODY:
+                return None
+            try:
+                ins = pic.instruction(a)
+            except ValueError:
+                continue
+            if ins is None:
+                continue
+
+            mnemonic = ins.info.mnemonic
+            if mnemonic in STOPS or mnemonic in isa.RETURNS and not routine:
+                return None
+            if ins.f is not None and a != self.address - 1:
+                # only the loop instruction may touch the counter, nothing may go through
+                # INDF and a write to BSR puts every bank in reach
+                if ins.f == f or ins.f in (isa.INDF0, isa.INDF1):
+                    return None
+                if isa.writes(ins):
+                    if ins.f in (isa.PCL, isa.PCLATH):
+                        return None
+                    written.add(ins.f)
+                    banked = banked or ins.f == isa.BSR
+            banked = banked or mnemonic == 'MOVLB'
+
+            if mnemonic in isa.RETURNS:
+                continue
+            elif a == self.address - 1:
+                todo.append((self.address, routine))
+            elif mnemonic == 'GOTO':
+                todo.append((page << 8 | ins.k, routine))
+            elif mnemonic == 'BRA':
+                todo.append((a + 1 + (ins.k ^ 0x100) - 0x100, routine))
+            elif mnemonic == 'CALL':
+                calls = True
+                todo += [(page << 8 | ins.k, True), (a + 1, routine)]
+            elif mnemonic in isa.SKIPS:
+                todo += [(a + 1, routine), (a + 2, routine)]
+            else:
+                todo.append((a + 1, routine))
+
+        # the registers any instruction can change besides its f, and the f written in the
+        # bank the loop runs in or, if the body changes BSR, in every bank
+        cells = {pic.cell_wreg, pic.cell_status, pic.cell_bsr, pic.cell_fsr0l, pic.cell_fsr0h,
+                 pic.cell_fsr1l, pic.cell_fsr1h, pic.cell_stkptr, pic.map[pic.data.reg['PCON']]}
+        banks = range(pic.device.banks) if banked else (bsr,)
+        cells.update(pic.map[(b << 7) | w] for w in written for b in banks)
+        cells.discard(pic.map[(bsr << 7) | f])
+        cells = sorted(c for c in cells if c < len(pic.mem))
+        addresses = sorted({a for a, _ in seen} | {self.address})
+        return Body(addresses, operator.itemgetter(*addresses), operator.itemgetter(*cells),
+                    calls)
+
+    def forward(self, cell, body, start):
+        ''' skip the remaining iterations that repeat the ones since start, leaving the last
+        to run.  False if the counter doesn't show the loop ran them all '''
+        pic = self.pic
+        _, count, profile, cycle_count, instruction_count, taken = start
+
+        # iterations between the samples.  the counter only steps, once per iteration, so it
+        # has to have moved by exactly that many without passing zero
+        length = self.taken - taken
+        value = pic.mem[cell]
+        if value != count + self.step * length:
+            return False
+
+        # repeats of those iterations that still end in the branch back.  a bounded run
+        # stops where it would have stopped stepping them
+        repeats = (value - 1 if self.step < 0 else 0xFF - value) // length
+        cycles = pic.cycle_count - cycle_count
+        instructions = pic.instruction_count - instruction_count
+        if pic.cycle_limit is not None:
+            repeats = min(repeats, (pic.cycle_limit - pic.cycle_count) // cycles)
+        if pic.instruction_limit is not None:
+            repeats = min(repeats,
+                          (pic.instruction_limit - pic.instruction_count) // instructions)
+        if repeats <= 0:
+            return True
+
+        profile = zip(body.addresses, body.profile(pic.cycles), profile)
+        for a, now, then in profile:
+            if now != then:
+                pic.cycles[a] += (now - then) * repeats
+                pic.ran[a] = 1
+        pic.cycle_count += cycles * repeats
+        pic.instruction_count += instructions * repeats
+        pic.mem[cell] = value + self.step * length * repeats
+        pic.dirty[cell] = 1
+        return True
+
+
+class IdleLoop:
+    ''' wraps the handler of a jump to itself '''
+
+    def __init__(self, pic, address, handler):
+        self.pic = pic
+        self.address = address
+        self.handler = handler
+
+    def __call__(self, ins):
+        self.handler(ins)
+        if self.pic.pc == self.address:
+            self.pic.idle = True
+
+
+def forget(pic):
+    ''' drop the loop bodies followed so far, when program memory changes '''
+    for loop in pic.loops.values():
+        loop.bodies.clear()
+
+
+def scan(pic, addresses):
+    ''' wrap the branch of any counted or idle loop ending at one of addresses '''
+    for address in addresses:
+        if not 0 <= address < len(pic.ops):
+            continue
+
+        # rewrap from scratch in case the counter instruction changed.  words not decoded yet
+        # are scanned when they are and erased words have nothing to wrap
+        handler, ins, cycles = pic.ops[address]
+        if ins is None:
+            continue
+        if isinstance(handler, (CountedLoop, IdleLoop)):
+            handler = handler.handler
+            pic.ops[address] = handler, ins, cycles
+        pic.loops.pop(address, None)
+
+        if is_loop(pic, address):
+            loop = pic.loops[address] = CountedLoop(pic, address, handler)
+            pic.ops[address] = loop, ins, cycles
+        elif target(address, ins) == address:
+            pic.ops[address] = IdleLoop(pic, address, handler), ins, cycles
+
+
+def is_loop(pic, address):
+    ''' True if address holds a GOTO or BRA back to a loop ending in DECFSZ/INCFSZ f,F '''
+    if address == 0:
+        return False
+    branch, counter = pic.ops[address], pic.ops[address - 1]
+    if branch[1] is None or counter[1] is None:
+        return False
+
+    to = target(address, branch[1])
+    if to is None:
+        return False
+
+    counter = counter[1]
+    return (counter.info.mnemonic in ('DECFSZ', 'INCFSZ') and counter.d == 1
+            and to < address)
+
+
+def target(address, ins):
+    ''' address a GOTO or BRA at address jumps to, None for any other instruction '''
+    if ins.info.mnemonic == 'GOTO':
+        return ins.k
+    if ins.info.mnemonic == 'BRA':
+        return address + 1 + (ins.k ^ 0x100) - 0x100
+    return None
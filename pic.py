@@ -12,114 +12,306 @@ todo:
 import re
 import time
 import array
+import collections
 
 import insdata
 import datamem
+import device
+import hexfile
+import devcache
+import blocks
+import loops
 
-MAXROM = 0x800
-MAXSTACK = 0x0010
+# value of an unprogrammed program memory word
+ERASED = 0x3FFF
+
+# program counter that stops a run.  GOTO 0x7FF is HALT.  so does running past program memory
+HALT = 0x7FF
+
+# instructions, or blocks when compiled, between checks of the wall clock
+CLOCK_CHECK = 0x400
+
+# machine state saved by Pic.snapshot.  mem and cycles are tuples of immutable pages
+Snapshot = collections.namedtuple(
+    'Snapshot', 'mem cycles stack pch alu cycle_count instruction_count idle')
+
+# bytes per snapshot page of the cycle profile, 128 addresses
+PROFILE_PAGESIZE = 0x400
+
+# why a run stopped and the cycles, instructions and host seconds it took
+RunResult = collections.namedtuple('RunResult', 'reason cycles instructions elapsed')
 
 
 class Pic:
-    def __init__(self, core):
-        ''' init class with table of instruction set data '''
+    def __init__(self, core, part=None):
+        ''' init class with table of instruction set data and the part name or Device whose
+        memory sizes to use '''
         
-        self.stack = array.array('H')
-        self.cycles = array.array('L')
-        self.data = datamem.DataMem(256, core.reg)
+        self.core = core
+        self.device = device.get(part)
+
+        # resolve each instruction type to its handler once rather than per instruction
+        self.handlers = {info: getattr(self, '_' + info.handler) for info in core.info_list}
+
+        # record in ops for a raw word that is decoded when first fetched and for an erased
+        # word, which stops the run with an error naming its address
+        self.lazy = (self.fetch, None, 0)
+        self.erased = (self.unprogrammed, None, 0)
+
+        rom = self.device.rom
+        self.stack = array.array('H', bytes(2 * self.device.stack))
+        self.words = array.array('H', [ERASED]) * rom
+        # cycles spent at each program address.  64 bit so long runs can't overflow and
+        # cleared in place so views handed out by profile() stay valid
+        self.cycles = array.array('Q', bytes(8 * rom))
+        # addresses whose cycles changed since the last snapshot or restore, see datamem
+        self.ran = bytearray(rom)
+        self.data = datamem.DataMem(self.device.gpr, core.reg, self.device.banks)
+        self.blocks = blocks.BlockCache(self)
+
+        # skip the repeated iterations of counted delay loops.  anything that must see every
+        # iteration clears it while it runs and puts it back after, see loops.  fast_calls
+        # does the same for loops that call a routine.  loops holds the wrapper of each
+        # counted loop by branch address
+        self.fast_loops = True
+        self.fast_calls = True
+        self.loops = {}
+
+        # the last snapshot taken or restored.  the next snapshot shares its unchanged pages
+        # and the next restore writes back only the pages written since or not shared
+        self.base = None
+
+        # absolute cycle and instruction counts a fast forward must not go past during a
+        # bounded run
+        self.cycle_limit = None
+        self.instruction_limit = None
         self.clear()
 
+        # the core registers are resolved to their cells in data memory and the STATUS bits
+        # to masks up front.  the cells are the same ones the banked and linear addresses
+        # map to so the memory mapped views of these registers stay in step
+        self.mem = self.data.mem
+        self.map = self.data.map
+        self.dirty = self.data.dirty
+        reg = core.reg
+        self.cell_pcl = self.map[reg['PCL']]
+        self.cell_status = self.map[reg['STATUS']]
+        self.cell_fsr0l = self.map[reg['FSR0L']]
+        self.cell_fsr0h = self.map[reg['FSR0H']]
+        self.cell_fsr1l = self.map[reg['FSR1L']]
+        self.cell_fsr1h = self.map[reg['FSR1H']]
+        self.cell_bsr = self.map[reg['BSR']]
+        self.cell_wreg = self.map[reg['WREG']]
+        self.cell_pclath = self.map[reg['PCLATH']]
+        self.cell_stkptr = self.map[reg['STKPTR']]
+        self.mask_c = 1 << reg['C']
+        self.mask_dc = 1 << reg['DC']
+        self.mask_z = 1 << reg['Z']
+
+        # cells the register properties write without a flag in dirty
+        self.cells_core = (
+            self.cell_pcl, self.cell_status, self.cell_fsr0l, self.cell_fsr0h, self.cell_fsr1l,
+            self.cell_fsr1h, self.cell_bsr, self.cell_wreg, self.cell_pclath, self.cell_stkptr)
+
+        # reads of STATUS through data memory bring the deferred flags up to date first
+        self.data.sync = self.sync_status
+
         # program counter high byte
         self.pch = 0
 
-        self.core = core
-
     def clear(self):
         ''' clear memory '''
-        # special function registers
-        self.prog = [None for i in range(MAXROM)]
+        rom = self.device.rom
+        self.prog = [None] * rom
+        # pre-decoded (handler, instruction, base cycles) records parallel to prog
+        self.ops = [self.erased] * rom
+        # raw program words parallel to prog.  unprogrammed words read as erased flash
+        self.words[:] = array.array('H', [ERASED]) * rom
+        # configuration words of the part, erased until a hex file sets them
+        self.config = dict.fromkeys(self.device.config, ERASED)
+        self.loops.clear()
+        self.blocks.invalidate()
         # cycle counts
-        self.cycles = [0 for i in range(MAXROM)]
+        self.cycles[:] = array.array('Q', bytes(8 * rom))
+        self.ran[:] = b'\x01' * rom
+        self.cycle_count = 0
+        self.instruction_count = 0
         # stack
-        self.stack = [0 for i in range(MAXSTACK)]
+        self.stack[:] = array.array('H', bytes(2 * len(self.stack)))
 
         self.data.clear()
 
+        # (a, b, carry, v) of the last arithmetic instruction whose flags have not been
+        # written to STATUS yet.  C is bit 8 of v, DC the carry out of adding the low
+        # nibbles of a, b and carry and Z is set if the low byte of v is zero
+        self.alu = None
+
         self.pch = 0
 
+        # set by SLEEP and by a jump to itself.  with no interrupts or peripherals to wake
+        # the core there is nothing more to run
+        self.idle = False
+
     def load_program(self, address, words):
         ''' load program memory '''
         for i, word in enumerate(words):
             self.prog[address + i] = word
+            self.ops[address + i] = self.resolve(word)
+            self.words[address + i] = ERASED if word is None else word.to_word()
+        loops.scan(self, range(address, address + len(words) + 1))
+        loops.forget(self)
+        self.blocks.invalidate()
+
+    def load_words(self, address, words):
+        ''' load raw program words.  each is decoded the first time it is fetched '''
+        for i, word in enumerate(words):
+            self.prog[address + i] = None
+            self.ops[address + i] = self.erased if word == ERASED else self.lazy
+            self.words[address + i] = word
+            self.loops.pop(address + i, None)
+        loops.forget(self)
+        self.blocks.invalidate()
+
+    def instruction(self, address):
+        ''' the Instruction at address, decoding it if it hasn't been yet '''
+        if self.ops[address] is self.lazy:
+            self.decode_at(address)
+        return self.prog[address]
+
+    def decode_at(self, address):
+        ''' decode the raw word at address into prog and ops '''
+        try:
+            self.prog[address] = self.core.decode(self.words[address])
+        except ValueError:
+            raise self.no_instruction(address) from None
+        self.ops[address] = self.resolve(self.prog[address])
+
+        # it may be the branch or the counter of a counted loop
+        loops.scan(self, (address, address + 1))
+        return self.ops[address]
+
+    def no_instruction(self, address):
+        ''' the error for running an address holding an erased or invalid word '''
+        word = self.words[address]
+        return ValueError('no instruction at 0x{:04X}: word 0x{:04X} is {}'.format(
+            address, word, 'erased' if word == ERASED else 'not an instruction'))
+
+    def fetch(self, ins):
+        ''' handler of the record standing in for words not decoded yet.  decodes the word
+        exec fetched, adds its cycles and runs it '''
+        address = self.ins_pc
+        handler, ins, cycles = self.ops[address]
+        if ins is None:
+            try:
+                handler, ins, cycles = self.decode_at(address)
+            except ValueError:
+                # leave the machine at the word as if it had never been fetched
+                self.pc = address
+                self.instruction_count -= 1
+                raise
+        self.inc_cycles(cycles)
+        handler(ins)
+
+    def unprogrammed(self, ins):
+        ''' handler of the record standing in for erased words.  leaves the machine at the
+        word as if it had never been fetched '''
+        self.pc = self.ins_pc
+        self.instruction_count -= 1
+        raise self.no_instruction(self.ins_pc)
+
+    def snapshot(self):
+        ''' save registers, data memory, stack, pc and cycle counters.  program memory is not
+        saved.  only the pages of data memory and the profile written since the last snapshot
+        or restore are read, the rest are shared with it, see datamem '''
+        base = self.base
+        self.mark_core()
+        self.base = Snapshot(
+            self.data.snapshot(base and base.mem),
+            datamem.take_pages(self.cycles, self.ran, base and base.cycles, PROFILE_PAGESIZE),
+            self.stack.tobytes(), self.pch, self.alu, self.cycle_count, self.instruction_count,
+            self.idle)
+        return self.base
+
+    def restore(self, snapshot):
+        ''' return to a snapshot, writing back only the memory pages written since the last
+        snapshot or restore and those it does not share with the snapshot '''
+        base = self.base
+        self.mark_core()
+        self.data.restore(snapshot.mem, base and base.mem)
+        datamem.put_pages(
+            self.cycles, self.ran, snapshot.cycles, base and base.cycles, PROFILE_PAGESIZE)
+        self.stack[:] = array.array('H', snapshot.stack)
+        self.pch, self.alu = snapshot.pch, snapshot.alu
+        self.cycle_count, self.instruction_count = snapshot.cycle_count, snapshot.instruction_count
+        self.idle = snapshot.idle
+
+        # counted loops part way through measuring an iteration start again
+        for loop in self.loops.values():
+            loop.reset()
+        self.base = snapshot
+
+    def mark_core(self):
+        ''' flag the core register cells, which the properties write directly '''
+        dirty = self.dirty
+        for cell in self.cells_core:
+            dirty[cell] = 1
+
+    def resolve(self, ins):
+        ''' build the pre-decoded record that exec runs for an instruction '''
+        if ins is None:
+            return self.erased
+        return self.handlers[ins.info], ins, ins.info.base_cycles
 
     def load_from_file(self, filename):
+        ''' load program memory from an intel hex file, a name, bytes or an mmap.  the part's
+        configuration words are copied to config.  returns the HexImage so the rest of the
+        configuration and the eeprom data are there for the caller '''
         self.clear()
-        
-        base = 0x00
-        
-        with open(filename) as fp:
-            for line in fp:
-                m = re.search('^:(\S\S)(\S\S\S\S)(\S\S)(\S*)(\S\S)', line.strip())
-                count, address, rectype, data, checksum = m.groups()
-        
-                # Convert data fields from hex
-                count = int(count, 16)
-        
-                # Look for a extended address record
-                if rectype == '04':
-                    base = int(data, 16) << 16
-        
-                # compute checksum of data
-                sum = 0
-                for hex_byte in [data[i: i + 2] for i in range(0, len(data), 2)]:
-                    sum += int(hex_byte, 16)
-                    
-                # add other fields from record
-                sum += count + int(address[0:2], 16) + int(address[2:4], 16) + int(rectype, 16)
-                
-                # convert to intel style
-                sum = '{:02X}'.format((~sum + 1) & 0xff)
-                
-                assert sum == checksum, "Record at address ({} {}) has bad checksum ({})  I get {}".format(base, address, checksum, sum)
-        
-                # load words into program mem
-                if rectype == '00':
-                    full_address = base + int(address, 16) // 2
-                    if full_address < len(self.prog):
-                        for i in range(count // 2):
-                            word = int(data[i * 4 + 2:i * 4 + 4] + data[i * 4:i * 4 + 2], 16)
-                            self.prog[full_address + i] = word
-        
-                            #print('{:04x} {:02x} {:02x} {:04x}'.format(full_address, count, i, word))
+        image = hexfile.read(filename)
+        if len(image.program) > self.device.rom:
+            raise ValueError('program of {} words does not fit in {}'.format(
+                len(image.program), self.device.rom))
+
+        # words are decoded as they are first run.  erased words stay unprogrammed
+        self.load_words(0, image.program)
+        self.config.update((a, w) for a, w in image.config.items() if a in self.config)
+        return image
 
     def load(self, f):
         ''' load data from banked memory '''
-        address = self.bsr + f
-        return self.data[address]
+        mem = self.mem
+        cell = self.map[(mem[self.cell_bsr] << 7) | f]
+        if cell == self.cell_status and self.alu:
+            self.sync_status()
+        return mem[cell]
     
     def load_indirect(self, address):
         ''' inderect adressing which can access fraditional, linear and program mem '''
-        if 0x8000 <= address < 0x8000 + MAXROM:
-            ins = self.prog[address - 0x8000]
-            word = int(ins.to_bits(), 2) if ins else 0
-            return word & 0xFF
-        elif address < 0x29B0:
+        if 0x8000 <= address < 0x8000 + len(self.words):
+            # only the low byte of a program word can be read through an FSR
+            return self.words[address - 0x8000] & 0xFF
+        elif address < self.data.linear:
             return self.data[address]
         else:
             return 0
 
     def store(self, f, value):
         ''' banked store '''
-        address = self.bsr + f
-        self.data[address] = value
+        mem = self.mem
+        cell = self.map[(mem[self.cell_bsr] << 7) | f]
+        if cell == self.cell_status:
+            # the whole register is being replaced so deferred flags are stale
+            self.alu = None
+        mem[cell] = value & 0xFF
+        self.dirty[cell] = 1
 
     def store_indirect(self, address, value):
-        if address < 0x29B0:
+        if address < self.data.linear:
             self.data[address] = value
         
     def set_data(self, address, value):
         ''' handles writing to special locations '''
-        if address < datamem.MAXRAM and address & 0x7F == self.core.reg['PCL']:
+        if address < self.data.ram and address & 0x7F == self.core.reg['PCL']:
             self.set_pc((self.pclath << 8) | value)
         else:
             self.data[address] = value
@@ -127,12 +319,13 @@ class Pic:
     def dump_program(self, address_list):
         ''' dump program memory '''
         for address in address_list:
-            print('{:04X}  '.format(address), self.prog[address])
+            print('{:04X}  '.format(address), self.instruction(address))
 
     def dump_profile(self, address_list):
         ''' dump program memory '''
         for address in address_list:
-            print('{:04X}   {:20} {:4}'.format(address, str(self.prog[address]), self.cycles[address]))
+            print('{:04X}   {:20} {:4}'.format(address, str(self.instruction(address)),
+                                               self.cycles[address]))
 
     def dump_data(self, addresses):
         self.data.dump(addresses)
@@ -147,114 +340,145 @@ class Pic:
 
     def inc_cycles(self, cycles):
         self.cycles[self.ins_pc] += cycles
+        self.ran[self.ins_pc] = 1
+        self.cycle_count += cycles
 
     def total_cycles(self):
-        total = 0
-        for c in self.cycles:
-            total += c
-        return total
+        return self.cycle_count
+
+    def profile(self):
+        ''' per address cycle counts as a view of the underlying 64 bit array.  no copy is
+        made, e.g. numpy.frombuffer(p.profile(), dtype=numpy.uint64).  writes through the
+        view are not seen by snapshots '''
+        return memoryview(self.cycles)
 
     @property
     def pc(self):
         ''' get the value of the program counter '''
-        return (self.pch << 8) | self.pcl
+        return (self.pch << 8) | self.mem[self.cell_pcl]
     
     @pc.setter
     def pc(self, address):
-        self.pch, self.pcl = divmod(address, 0X100)
+        self.pch, self.mem[self.cell_pcl] = divmod(address, 0X100)
 
     @property
     def pcl(self):
-        return self.data['PCL']
+        return self.mem[self.cell_pcl]
         
     @pcl.setter
     def pcl(self, value):
-        self.data['PCL'] = value
+        self.mem[self.cell_pcl] = value & 0xFF
 
     @property
     def pclath(self):
-        return self.data['PCLATH']
+        return self.mem[self.cell_pclath]
         
     @pclath.setter
     def pclath(self, value):
-        self.data['PCLATH'] = value
+        self.mem[self.cell_pclath] = value & 0xFF
 
     @property
     def wreg(self):
-        return self.data['WREG']
+        return self.mem[self.cell_wreg]
         
     @wreg.setter
     def wreg(self, value):
-        self.data['WREG'] = value
+        self.mem[self.cell_wreg] = value & 0xFF
 
     @property
     def bsr(self):
-        return self.data['BSR']
+        return self.mem[self.cell_bsr]
         
     @bsr.setter
     def bsr(self, value):
-        self.data['BSR'] = value
+        self.mem[self.cell_bsr] = value & 0xFF
 
     @property
     def fsr0(self):
-        return (self.data['FSR0H'] << 8) | self.data['FSR0L']
+        return (self.mem[self.cell_fsr0h] << 8) | self.mem[self.cell_fsr0l]
         
     @fsr0.setter
     def fsr0(self, value):
-        self.data['FSR0H'], self.data['FSR0L'] = divmod(value % 0x10000, 0x100)
+        self.mem[self.cell_fsr0h], self.mem[self.cell_fsr0l] = divmod(value % 0x10000, 0x100)
 
     @property
     def fsr1(self):
-        return (self.data['FSR1H'] << 8) | self.data['FSR1L']
+        return (self.mem[self.cell_fsr1h] << 8) | self.mem[self.cell_fsr1l]
         
     @fsr1.setter
     def fsr1(self, value):
-        self.data['FSR1H'], self.data['FSR1L'] = divmod(value % 0x10000, 0x100)
+        self.mem[self.cell_fsr1h], self.mem[self.cell_fsr1l] = divmod(value % 0x10000, 0x100)
 
     @property
     def stkptr(self):
-        return self.data['STKPTR']
+        return self.mem[self.cell_stkptr]
     
     @stkptr.setter
     def stkptr(self, value):
-        self.data['STKPTR'] = value
+        self.mem[self.cell_stkptr] = value & 0xFF
 
     @property
     def z(self):
         ''' get STATUS register zero bit as 0 or 1 '''
-        return self.get_bit('STATUS', 'Z')
+        if self.alu:
+            self.sync_status()
+        return 1 if self.mem[self.cell_status] & self.mask_z else 0
 
     @z.setter
     def z(self, value):
+        if self.alu:
+            self.sync_status()
         if value:
-            self.set_bit('STATUS', 'Z')
+            self.mem[self.cell_status] |= self.mask_z
         else:
-            self.clear_bit('STATUS', 'Z')
+            self.mem[self.cell_status] &= ~self.mask_z
 
     @property
     def c(self):
         ''' get STATUS register carry bit as 0 or 1 '''
-        return self.get_bit('STATUS', 'C')
+        if self.alu:
+            self.sync_status()
+        return 1 if self.mem[self.cell_status] & self.mask_c else 0
 
     @c.setter
     def c(self, value):
+        if self.alu:
+            self.sync_status()
         if value:
-            self.set_bit('STATUS', 'C')
+            self.mem[self.cell_status] |= self.mask_c
         else:
-            self.clear_bit('STATUS', 'C')
+            self.mem[self.cell_status] &= ~self.mask_c
 
     @property
     def dc(self):
         ''' get STATUS register digit carry bit as 0 or 1 '''
-        return self.get_bit('STATUS', 'DC')
+        if self.alu:
+            self.sync_status()
+        return 1 if self.mem[self.cell_status] & self.mask_dc else 0
     
     @dc.setter
     def dc(self, value):
+        if self.alu:
+            self.sync_status()
         if value:
-            self.set_bit('STATUS', 'DC')
+            self.mem[self.cell_status] |= self.mask_dc
         else:
-            self.clear_bit('STATUS', 'DC')
+            self.mem[self.cell_status] &= ~self.mask_dc
             
+    def sync_status(self):
+        ''' write the flags of a deferred arithmetic result into STATUS '''
+        if self.alu:
+            a, b, carry, v = self.alu
+            self.alu = None
+            status = self.mem[self.cell_status] & ~(self.mask_c | self.mask_dc | self.mask_z)
+            if v & 0x100:
+                status |= self.mask_c
+            if ((a & 0x0F) + (b & 0x0F) + carry) & 0x10:
+                status |= self.mask_dc
+            if not v & 0xFF:
+                status |= self.mask_z
+            self.mem[self.cell_status] = status
+
     def get_bit(self, register, bit_number):
         ''' get a bit in register specified by number or name '''
         if isinstance(bit_number, str):
@@ -282,11 +506,12 @@ class Pic:
         sp = self.stkptr
 
         # Set overflow bit
-        if sp == 0x0F:
+        top = len(self.stack) - 1
+        if sp == top:
             self.set_bit('PCON', 'STKOVR')
 
         # STVREN is not implemented so stack wraps and no reset occurs
-        sp = (sp + 1) & 0x0F
+        sp = (sp + 1) & top
 
         # save return address and update STKPTR
         self.stack[sp] = self.pc
@@ -305,10 +530,11 @@ class Pic:
         self.pc = self.stack[sp]
 
         # STVREN is not implemented so stack wraps and no reset occurs
-        self.stkptr = (sp - 1) & 0x0F
+        self.stkptr = (sp - 1) & (len(self.stack) - 1)
 
     def preset(self):
         self.data.clear()
+        self.alu = None
 #        if cond is None or cond == self.reg['NOT_POR']:
 #            self.data['PCON'] = 0
 #            self.set_bit('PCON', 'NOT_POR')
@@ -320,91 +546,88 @@ class Pic:
 
         self.stkptr = 0x1F
 
-    def run(self, verbose=False):
-        ''' run until pc == 07FF. i.e. GOTO 0x7FF is HALT '''
-        start = time.clock()
-        while self.pc < 0x7FF:
-            if verbose:
-                self.status()
-            self.exec(verbose)
-
+    def run(self, verbose=False, compiled=False, **limits):
+        ''' run until pc == 07FF. i.e. GOTO 0x7FF is HALT, or until the core goes idle in a
+        SLEEP or a jump to itself.  compiled runs whole basic blocks compiled to python
+        functions rather than stepping each instruction.  limits are passed on to simulate '''
+        result = self.simulate(verbose, compiled, **limits)
         self.status()
 
         if verbose:
-            print('runtime: {:0.2f}ms'.format((time.clock() - start) * 1000))
+            print('runtime: {:0.2f}ms'.format(result.elapsed * 1000))
+
+    def simulate(self, verbose=False, compiled=False, max_cycles=None, max_instructions=None,
+                 timeout=None, stop_at=(), until=None, trace=None):
+        ''' run until HALT, idle or one of the limits is reached and return a RunResult.
+        max_cycles and max_instructions bound the cycles and instructions run, timeout the
+        host seconds.  the run also stops when it reaches an address in stop_at, other than
+        the one it starts from, and once until(pic) returns True.  only the checks asked for
+        are built into the run loop.  compiled runs check the limits after each block so may
+        overshoot them by the rest of a block.  reason is one of halt, idle, cycles,
+        instructions, timeout, address or until.  a tracer.Trace passed as trace records
+        every instruction run '''
+        start = time.perf_counter()
+        cycle_count, instruction_count = self.cycle_count, self.instruction_count
+        self.idle = False
+
+        # single stepping verbosely or tracing shows every iteration of a loop and a stop
+        # address or predicate must see every one, so none are skipped
+        fast_loops = self.fast_loops
+        self.fast_loops = (fast_loops and not verbose and trace is None and not stop_at
+                           and until is None)
+
+        stop_at = frozenset(stop_at)
+        if max_cycles is not None:
+            self.cycle_limit = cycle_count + max_cycles
+        if max_instructions is not None:
+            self.instruction_limit = instruction_count + max_instructions
+
+        if trace is not None:
+            step = trace.attach(self)
+        elif verbose:
+            def step():
+                self.status()
+                self.exec(True)
+        elif compiled:
+            self.blocks.set_boundaries(stop_at | {HALT})
+            step = self.blocks.step
+        else:
+            step = self.exec
+
+        loop = build_loop(self, step, self.cycle_limit, self.instruction_limit,
+                          start + timeout if timeout is not None else None, stop_at, until)
+        try:
+            reason = loop()
+        finally:
+            self.fast_loops = fast_loops
+            self.cycle_limit = self.instruction_limit = None
+            if trace is not None:
+                trace.detach()
+
+        return RunResult(reason, self.cycle_count - cycle_count,
+                         self.instruction_count - instruction_count, time.perf_counter() - start)
 
     def exec(self, verbose=False):
         ''' exec a single instruction '''
  
-        ins = self.prog[self.pc]
+        pc = self.pc
+        handler, ins, cycles = self.ops[pc]
 
         # display instruction
         if verbose:
-            print('{:04X}  '.format(self.pc), ins)
+            print('{:04X}  '.format(pc), self.instruction(pc))
 
-        self.ins_pc, self.pc = self.pc, self.pc + 1
-        cycles = ins.info.cycles.split(',')[0]
-        self.inc_cycles(int(cycles))
+        self.ins_pc, self.pc = pc, pc + 1
+        self.cycles[pc] += cycles
+        self.ran[pc] = 1
+        self.cycle_count += cycles
+        self.instruction_count += 1
 
-        self.dispatch(ins)
+        handler(ins)
 
     def dispatch(self, ins):
         ''' dispatch opcode to handler '''
-        return {
-            'ADDFSR': self._addfsr,
-            'ADDLW': self._addlw,
-            'ADDWF': self._addwf,
-            'ADDWFC': self._addwfc,
-            'ANDLW': self._andlw,
-            'ANDWF': self._andwf,
-            'ASRF': self._asrf,
-            'BCF': self._bcf,
-            'BRA': self._bra,
-            'BRW': self._brw,
-            'BSF': self._bsf,
-            'BTFSC': self._btfsc,
-            'BTFSS': self._btfss,
-            'CALL': self._call,
-            'CALLW': self._callw,
-            'CLRF': self._clrf,
-            'CLRW': self._clrw,
-            'CLRWDT': self._clrwdt,
-            'COMF': self._comf,
-            'DECF': self._decf,
-            'DECFSZ': self._decfsz,
-            'GOTO': self._goto,
-            'INCF': self._incf,
-            'INCFSZ': self._incfsz,
-            'IORLW': self._iorlw,
-            'IORWF': self._iorwf,
-            'LSLF': self._lslf,
-            'LSRF': self._lsrf,
-            'MOVF': self._movf,
-            'MOVIWK': self._moviwk,
-            'MOVIWM': self._moviwm,
-            'MOVLB': self._movlb,
-            'MOVLP': self._movlp,
-            'MOVLW': self._movlw,
-            'MOVWF': self._movwf,
-            'MOVWIK': self._movwik,
-            'MOVWIM': self._movwim,
-            'NOP': self._nop,
-            'OPTION': self._option,
-            'RESET': self._reset,
-            'RETFIE': self._retfie,
-            'RETLW': self._retlw,
-            'RETURN': self._return,
-            'RLF': self._rlf,
-            'RRF': self._rrf,
-            'SLEEP': self._sleep,
-            'SUBLW': self._sublw,
-            'SUBWF': self._subwf,
-            'SUBWFB': self._subwfb,
-            'SWAPF': self._swapf,
-            'TRIS': self._tris,
-            'XORLW': self._xorlw,
-            'XORWF': self._xorwf,
-        }[ins.info.mnemonic](ins)
+        return self.handlers[ins.info](ins)
         
     # opcode implementations
     def _addfsr(self, ins):
@@ -415,36 +638,33 @@ class Pic:
             self.fsr1 += k
 
     def _addlw(self, ins):
-        v = self.wreg + ins.k
-        r = (self.wreg & 0x0f) + (ins.k & 0xf)
+        w = self.wreg
+        v = w + ins.k
         self.wreg = v
-        self.c = v & 0x100
-        self.dc = r & 0x10
-        self.z = not (v & 0xff)
+        self.alu = w, ins.k, 0, v
 
     def _addwf(self, ins):
         f = ins.f
-        v = self.load(f) + self.wreg
-        r = (self.load(f) & 0x0f) + (self.wreg & 0x0f)
+        x = self.load(f)
+        w = self.wreg
+        v = x + w
         if ins.d == 0:
             self.wreg = v
         else:
             self.store(f, v)
-        self.c = v & 0x100
-        self.dc = r & 0x10
-        self.z = not (v & 0xff)
+        self.alu = x, w, 0, v
 
     def _addwfc(self, ins):
         f = ins.f
-        v = self.load(f) + self.wreg + self.c
-        r = (self.load(f) & 0x0f) + (self.wreg & 0x0f) + self.c
+        x = self.load(f)
+        w = self.wreg
+        c = self.c
+        v = x + w + c
         if ins.d == 0:
             self.wreg = v
         else:
             self.store(f, v)
-        self.c = v & 0x100
-        self.dc = r & 0x10
-        self.z = not (v & 0xff)
+        self.alu = x, w, c, v
 
     def _andlw(self, ins):
         v = self.wreg & ins.k
@@ -499,11 +719,11 @@ class Pic:
 
     def _call(self, ins):
         self.push()
-        self.pc = (self.pclath & 0b01111000 << 8) | ins.k
+        self.pc = ((self.pclath & 0b01111000) << 8) | ins.k
 
     def _callw(self, ins):
         self.push()
-        self.pc = (self.pclath & 0b01111111 << 8) | self.wreg
+        self.pc = ((self.pclath & 0b01111111) << 8) | self.wreg
 
     def _clrf(self, ins):
         self.store(ins.f, 0)
@@ -518,7 +738,7 @@ class Pic:
 
     def _comf(self, ins):
         f = ins.f
-        v = (self.load(f) - 1) & 0xFF
+        v = (~self.load(f)) & 0xFF
         if ins.d == 0:
             self.wreg = v
         else:
@@ -527,7 +747,7 @@ class Pic:
 
     def _decf(self, ins):
         f = ins.f
-        v = (~self.load(f)) & 0xFF
+        v = (self.load(f) - 1) & 0xFF
         if ins.d == 0:
             self.wreg = v
         else:
@@ -546,7 +766,7 @@ class Pic:
             self.inc_cycles(1)
 
     def _goto(self, ins):
-        self.pc = (self.pclath & 0b01111000 << 8) | ins.k
+        self.pc = ((self.pclath & 0b01111000) << 8) | ins.k
 
     def _incf(self, ins):
         f = ins.f
@@ -613,7 +833,7 @@ class Pic:
 
     def _moviwk(self, ins):
         k = twos_complement(ins.k, 6)
-        a = (self.fsr0 if ins.n == 0 else self.fsr1) + k
+        a = ((self.fsr0 if ins.n == 0 else self.fsr1) + k) & 0xFFFF
         v = self.load_indirect(a)
         self.wreg = v
         self.z = v == 0
@@ -626,7 +846,7 @@ class Pic:
             a += 1
         elif m == 1:
             a -= 1
-        v = self.load_indirect(a)
+        v = self.load_indirect(a & 0xFFFF)
         self.wreg = v
         self.z = v == 0
         if m == 2:
@@ -654,7 +874,7 @@ class Pic:
 
     def _movwik(self, ins):
         k = twos_complement(ins.k, 6)
-        a = (self.fsr0 if ins.n == 0 else self.fsr1) + k
+        a = ((self.fsr0 if ins.n == 0 else self.fsr1) + k) & 0xFFFF
         self.store_indirect(a, self.wreg)
 
     def _movwim(self, ins):
@@ -664,7 +884,7 @@ class Pic:
             a += 1
         elif m == 1:
             a -= 1
-        self.store_indirect(a, self.wreg)
+        self.store_indirect(a & 0xFFFF, self.wreg)
         if m == 2:
             a += 1
         elif m == 3:
@@ -678,7 +898,7 @@ class Pic:
         pass
 
     def _option(self, ins):
-        self.data['OPTION'] = self.wreg
+        self.data['OPTION_REG'] = self.wreg
 
     def _reset(self, ins):
         self.reset()
@@ -713,40 +933,38 @@ class Pic:
         self.c = v & 0x01
 
     def _sleep(self, ins):
-        pass
+        self.set_bit('STATUS', 'NOT_TO')
+        self.clear_bit('STATUS', 'NOT_PD')
+        self.idle = True
 
     def _sublw(self, ins):
-        v = ((-self.wreg) & 0xFF) + ins.k
-        r = ((-self.wreg) & 0x0F) + (ins.k & 0x0F)
+        w = (-self.wreg) & 0xFF
+        v = w + ins.k
         self.wreg = v
-        self.c = v & 0x100
-        self.dc = r & 0x10
-        self.z = not (v & 0xff)
-        pass
+        self.alu = w, ins.k, 0, v
 
     def _subwf(self, ins):
         f = ins.f
-        v = ((-self.wreg) & 0xFF) + self.load(f)
-        r = ((-self.wreg) & 0x0F) + (self.load(f) & 0x0F)
+        x = self.load(f)
+        w = (-self.wreg) & 0xFF
+        v = w + x
         if ins.d == 0:
             self.wreg = v
         else:
             self.store(f, v)
-        self.c = v & 0x100
-        self.dc = r & 0x10
-        self.z = not (v & 0xff)
+        self.alu = w, x, 0, v
 
     def _subwfb(self, ins):
         f = ins.f
-        v = self.load(f) + ((-self.wreg) & 0xFF) - (1 - self.c)
-        r = (self.load(f) & 0x0F) + ((-self.wreg) & 0x0F) + (1 - self.c)
+        x = self.load(f)
+        w = (-self.wreg) & 0xFF
+        borrow = 1 - self.c
+        v = x + w - borrow
         if ins.d == 0:
             self.wreg = v
         else:
             self.store(f, v)
-        self.c = v & 0x100
-        self.dc = r & 0x10
-        self.z = not (v & 0xff)
+        self.alu = x, w, borrow, v
 
     def _swapf(self, ins):
         f = ins.f
@@ -754,7 +972,7 @@ class Pic:
         if ins.d == 0:
             self.wreg = (v << 4) & 0xFF | (v >> 4)
         else:
-            self.store((v << 4) & 0xFF | (v >> 4))
+            self.store(f, (v << 4) & 0xFF | (v >> 4))
 
     def _tris(self, ins):
         if ins.f == 0b101:
@@ -793,8 +1011,26 @@ class InstructionInfo:
         self.opcode = m.group(1)
         self.field_spans = tuple(m.span(i + 1) for i in range(len(self.field_list)))
 
+        # opcode as an integer and the number of operand bits below it
+        self.opcode_shift = 14 - len(self.opcode)
+        self.opcode_value = int(self.opcode, 2) << self.opcode_shift
+
+        # (name, shift, mask) to extract each operand field from a program word
+        self.field_masks = tuple((name, 14 - y, (1 << (y - x)) - 1)
+                                 for name, (x, y) in zip(self.field_list[1:], self.field_spans[1:])
+                                 if x != y)
+
         # make a tuple for convenience
         self.arg = tuple(arg.split(','))
+
+        # base cycle count.  skip instructions add their extra cycle when they skip
+        self.base_cycles = int(self.cycles.split(',')[0])
+
+        # name of the Pic handler method.  MOVIW and MOVWI each have an indexed (k[n])
+        # and a pre/post inc/dec (n mm) form
+        self.handler = self.mnemonic.lower()
+        if self.mnemonic in ('MOVIW', 'MOVWI'):
+            self.handler += 'k' if '[' in arg else 'm'
         
     def __str__(self):
         s = self.opcode
@@ -806,32 +1042,52 @@ class InstructionInfo:
 
 
 class Instruction:
-    ''' instruction instance '''
-    def __init__(self, info, fields):
-        self.info = info
-        self.fields = fields
-    
-    def __getattr__(self, name):
-        if name == 'opcode':
-            return self.info.opcode
-        elif name in self.fields:
-            return self.fields[name]
-        else:
-            return None
-    
+    ''' instruction instance.  immutable.  holds the 14 bit program word and the operand fields
+    pulled out of it, None for fields the instruction doesn't have '''
+
+    __slots__ = ('info', 'word', 'b', 'd', 'f', 'n', 'm', 'k')
+
+    def __init__(self, info, fields=None, word=None):
+        ''' build from a dict of operand fields or from a program word '''
+        if word is None:
+            word = info.opcode_value
+            for name, shift, mask in info.field_masks:
+                value = fields.get(name)
+                if value is not None:
+                    word |= (value & mask) << shift
+
+        init = object.__setattr__
+        init(self, 'info', info)
+        init(self, 'word', word)
+        for name in InstructionInfo.field_list[1:]:
+            init(self, name, None)
+        for name, shift, mask in info.field_masks:
+            init(self, name, (word >> shift) & mask)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Instruction is immutable')
+
+    def __eq__(self, other):
+        return isinstance(other, Instruction) and (self.info, self.word) == (other.info, other.word)
+
+    def __hash__(self):
+        return hash(self.word)
+
+    def __reduce__(self):
+        return Instruction, (self.info, None, self.word)
+
+    @property
+    def opcode(self):
+        return self.info.opcode
+
+    def to_word(self):
+        ''' the 14 bit program word '''
+        return self.word
+
     def to_bits(self):
         ''' convert instruction into 14 bit string '''
-        bits = self.info.opcode
-        
-        # build instruction from fields starting after opcode
-        for i, field_name in enumerate(InstructionInfo.field_list[1:], 1):
-            x, y = self.info.field_spans[i]
-            value = getattr(self, field_name)
-            if value is not None:
-                bits += '{:0{}b}'.format(value, y - x)
+        return '{:014b}'.format(self.word)
 
-        return bits
-    
     def __str__(self):
         if self.f is not None and self.d is not None:
             sd = 'W' if self.d == 0 else 'F'
@@ -853,8 +1109,19 @@ class Instruction:
 class Decoder:
     ''' Decodes and encodes instructions from/to 14 bit program words'''
         
-    def __init__(self, ins_data, inc_file):
-        ''' parse instruction table and build lookup tables '''
+    def __init__(self, ins_data, inc_file, cache=True):
+        ''' parse instruction table and build lookup tables.  the tables are loaded from the
+        device cache when the sources are unchanged '''
+        # instructions are immutable so each word is decoded once and the Instruction shared
+        self.decoded = {}
+
+        if cache:
+            digest = devcache.key(ins_data, inc_file, (__file__,))
+            tables = devcache.load(inc_file, digest)
+            if tables is not None:
+                self.info_list, self.mnemonic_dict, self.decode_table, self.reg = tables
+                return
+
         self.info_list = []
         self.mnemonic_dict = {}
 
@@ -863,9 +1130,21 @@ class Decoder:
             self.info_list.append(info)
             self.mnemonic_dict[info.mnemonic] = info
 
+        # table of InstructionInfo indexed by 14 bit program word.  fill in order of
+        # increasing opcode length so the more specific opcodes (OPTION, SLEEP) win
+        # over the wider ones that contain them (TRIS)
+        self.decode_table = [None] * 0x4000
+        for info in sorted(self.info_list, key=lambda info: len(info.opcode)):
+            span = 1 << info.opcode_shift
+            self.decode_table[info.opcode_value:info.opcode_value + span] = [info] * span
+
         # load include file with reg definitions
         self.load_inc_file(inc_file)
 
+        if cache:
+            devcache.save(inc_file, digest,
+                          (self.info_list, self.mnemonic_dict, self.decode_table, self.reg))
+
     def load_inc_file(self, filename):
         ''' load the register and config word definitions from .inc file and build a dict '''
         
@@ -879,24 +1158,15 @@ class Decoder:
                     self.reg[name] = int(value, 16)
 
     def decode(self, word):
-        ''' return an Instruction consisting of info and dict of fields (b, d, f, n, m, k) '''
-
-        # convert program word to a bit string
-        bits = '{:014b}'.format(word)
-
-        # the instruction word starts with the instruction opcode.  Use a generator
-        # comprehension to find match.  It returns a list so use a comma on the lhs
-        # to force an unpack.  An exception is thrown if no or multiple matches
-        info, = [item for item in self.info_list if bits.startswith(item.opcode)]
+        ''' return the Instruction for a 14 bit program word '''
 
-        # build list of fields
-        fields = {}
-        for name, span in zip(info.field_list, info.field_spans):
-            x, y = span
-            if x != y:
-                fields[name] = int(bits[x:y], 2)
-      
-        return Instruction(info, fields)
+        ins = self.decoded.get(word)
+        if ins is None:
+            info = self.decode_table[word]
+            if info is None:
+                raise ValueError('invalid instruction word 0x{:04X}'.format(word))
+            ins = self.decoded[word] = Instruction(info, word=word)
+        return ins
 
     def encode(self, mnemonic, **kwargs):
         info = self.mnemonic_dict[mnemonic.upper()]
@@ -1001,6 +1271,43 @@ class Decoder:
         return code, symtab
 
 
+def build_loop(pic, step, cycle_limit, instruction_limit, deadline, stop_at, until):
+    ''' generate a run loop calling step with only the stop checks that are needed '''
+    names = {'pic': pic, 'step': step, 'clock': time.perf_counter, 'stop_at': stop_at,
+             'until': until}
+
+    # limits that can already be met before anything runs.  running off the end of program
+    # memory halts too, which on a 2K part is any pc from HALT up
+    rom = pic.device.rom
+    halt = 'pc >= {}'.format(HALT) if rom == HALT + 1 else 'pc == {} or pc >= {}'.format(HALT, rom)
+    checks = ['pc = pic.pc', 'if {}: return "halt"'.format(halt)]
+    if cycle_limit is not None:
+        checks.append('if pic.cycle_count >= {}: return "cycles"'.format(cycle_limit))
+    if instruction_limit is not None:
+        checks.append('if pic.instruction_count >= {}: return "instructions"'.format(
+            instruction_limit))
+
+    lines = list(checks)
+    if deadline is not None:
+        lines.append('n = 0')
+    lines += ['while True:', '    step()']
+    lines += ['    ' + line for line in checks]
+    lines.append('    if pic.idle: return "idle"')
+    if deadline is not None:
+        names['deadline'] = deadline
+        lines.append('    n += 1')
+        lines.append('    if not n % {} and clock() >= deadline: return "timeout"'.format(
+            CLOCK_CHECK))
+    if stop_at:
+        lines.append('    if pc in stop_at: return "address"')
+    if until is not None:
+        lines.append('    if until(pic): return "until"')
+
+    source = 'def loop():\n' + ''.join('    {}\n'.format(line) for line in lines)
+    exec(source, names)
+    return names['loop']
+
+
 def to2comp(input_value, num_bits):
     if input_value < 0:
         return 2**num_bits + input_value
@@ -1014,6 +1321,11 @@ def twos_complement(input_value, num_bits):
     return -(input_value & mask) + (input_value & ~mask)
 
 
+def lookup(symtab, label):
+    ''' program address of a label of an assembler symtab, or label if it is an address '''
+    return symtab[label.upper()] if isinstance(label, str) else label
+
+
 def code3(p, d):
     source = '''
 x       equ 0x20
@@ -0,0 +1,132 @@
+'''
+characterize the cycle counts of a routine over its inputs.
+
+the routine is called at its entry point with a return address of HALT pushed on the stack so
+its RETURN (or RETLW) ends the run.  every input value is a whole number split into bytes over
+the input registers, least significant register first, so a 16 bit routine taking its
+argument in x_lo and x_hi sweeps values 0 to 0xFFFF with inputs=('x_lo', 'x_hi').  the full
+domain is run unless a number of samples is asked for.
+
+inputs run in chunks on the lockstep engine and chunks are spread over a pool of worker
+processes, each set up once by batch.init.  numpy is needed.
+'''
+
+import os
+import concurrent.futures
+
+import numpy as np
+
+import pic
+import lockstep
+import batch
+
+# inputs run together on one lockstep engine
+CHUNK = 0x4000
+
+def load(program, entry):
+    ''' the worker's Pic with program loaded, about to call entry '''
+    p, symtab = batch.load(program)
+
+    # calling the routine from HALT means its return stops the run
+    p.pc = pic.HALT
+    p.push()
+    p.pc = pic.lookup(symtab, entry)
+    return p
+
+
+def run_chunk(program, entry, inputs, outputs, values, presets=None, max_cycles=None):
+    ''' run the routine for each input value and return cycles, outputs and stop reasons '''
+    p = load(program, entry)
+    for register, value in (presets or {}).items():
+        p.data[register] = value
+
+    engine = lockstep.Lockstep(p, len(values))
+    for i, register in enumerate(inputs):
+        engine.write(register, values >> (8 * i))
+    reasons = engine.run(max_cycles)
+
+    table = np.stack([engine.read(register) for register in outputs], axis=1) if outputs else \
+        np.zeros((len(values), 0), np.uint8)
+    return engine.cycles.copy(), table, reasons
+
+
+class Characterization:
+    ''' cycle counts and outputs of a routine for each input value it was run with '''
+
+    def __init__(self, inputs, outputs, values, cycles, table, reasons):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.values = values
+        self.cycles = cycles
+        self.table = table
+        self.reasons = reasons
+
+    @property
+    def min(self):
+        return int(self.cycles.min())
+
+    @property
+    def max(self):
+        return int(self.cycles.max())
+
+    @property
+    def mean(self):
+        return float(self.cycles.mean())
+
+    def histogram(self):
+        ''' dict of number of inputs by cycle count '''
+        counts, number = np.unique(self.cycles, return_counts=True)
+        return dict(zip(counts.tolist(), number.tolist()))
+
+    def worst(self):
+        ''' input values that take the most cycles '''
+        return self.values[self.cycles == self.cycles.max()]
+
+    def incomplete(self):
+        ''' input values whose run did not return from the routine '''
+        return self.values[self.reasons != lockstep.HALT]
+
+    def rows(self):
+        ''' (input value, cycles, output values) for every input '''
+        for value, cycles, outputs in zip(self.values, self.cycles, self.table):
+            yield int(value), int(cycles), tuple(outputs.tolist())
+
+    def dump(self):
+        ''' print the summary and histogram '''
+        print('inputs: {}  min: {}  max: {}  mean: {:0.2f}'.format(
+            len(self.values), self.min, self.max, self.mean))
+        for cycles, number in sorted(self.histogram().items()):
+            print('{:8d} {:8d}'.format(cycles, number))
+        worst = self.worst()
+        print('worst: {}{}'.format(' '.join('{:X}'.format(v) for v in worst[:8]),
+                                   ' ...' if len(worst) > 8 else ''))
+
+
+def characterize(program, entry, inputs, outputs=(), samples=None, seed=0, presets=None,
+                 max_cycles=None, workers=None, inc_file=batch.INC_FILE, chunk=CHUNK):
+    ''' run a routine over every value of its inputs, or samples of them picked at random,
+    and return a Characterization.  program is assembler source or program words and entry
+    a label of the source or an address.  the rest are register names or addresses '''
+    inputs, outputs = tuple(inputs), tuple(outputs)
+    domain = 1 << (8 * len(inputs))
+    if samples is None or samples >= domain:
+        values = np.arange(domain, dtype=np.int64)
+    else:
+        values = np.random.default_rng(seed).choice(domain, samples, replace=False)
+        values.sort()
+
+    chunks = [values[i:i + chunk] for i in range(0, len(values), chunk)]
+    args = (program, entry, inputs, outputs)
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers <= 1:
+        batch.init(inc_file)
+        results = [run_chunk(*args, c, presets, max_cycles) for c in chunks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=batch.init, initargs=(inc_file,)) as executor:
+            futures = [executor.submit(run_chunk, *args, c, presets, max_cycles)
+                       for c in chunks]
+            results = [future.result() for future in futures]
+
+    cycles, table, reasons = (np.concatenate(part) for part in zip(*results))
+    return Characterization(inputs, outputs, values, cycles, table, reasons)
@@ -0,0 +1,417 @@
+'''
+binary execution trace of a Pic run.
+
+every instruction run adds one fixed size record: the cycle count before it ran, its address
+and program word, the data address of the file register it wrote, if any, and the value that
+register holds after it, and W, STATUS, BSR and STKPTR after it, the state status() prints.
+records are packed into a preallocated ring buffer.  without a file the ring keeps the most
+recent capacity records.  with one, the file is preallocated to capacity records and mapped,
+records are packed straight into the map and a full map doubles the file, so the file holds
+the whole run.  close cuts it down to the records taken.  the file is nothing but records so
+it maps straight into numpy, load(filename) or numpy.memmap(filename, dtype()).
+
+long traces are better written chunked.  records are gathered into chunks of CHUNK records.
+each chunk is delta encoded, every record xor'd with the one before it so the fields that did
+not change become zeros, split into planes of the n-th byte of every record, which turns
+those zeros into long runs, and compressed with zlib.  an index file alongside, the trace file
+name plus INDEX, has an entry for each chunk giving its offset and length in the trace file,
+the number of records, the cycles of the first and last record and a compressed bitmap of the
+addresses run in it.  TraceFile reads the index and then decodes only the chunks a lookup by
+record number, cycle or address needs.
+
+the file register an instruction writes through f is known from the instruction, f in the
+bank BSR selects as it starts, so it is worked out once per address the first time the
+address runs.  only the address MOVWI writes comes from an FSR, and that is caught by
+replacing the Pic's store_indirect with a recording version while the trace is attached.  a
+traced run single steps and does not fast forward loops so every instruction is recorded.
+numpy is only needed to load a trace.
+'''
+
+import mmap
+import zlib
+import bisect
+import struct
+
+import isa
+
+# cycle, pc, word, address, value, W, STATUS, BSR, STKPTR
+RECORD = struct.Struct('<QHHHBBBBB')
+
+# numpy field names and types of a record
+FIELDS = [('cycle', '<u8'), ('pc', '<u2'), ('word', '<u2'), ('address', '<u2'),
+          ('value', 'u1'), ('w', 'u1'), ('status', 'u1'), ('bsr', 'u1'), ('sp', 'u1')]
+
+# offset of pc in a record
+PC = 8
+
+# address of a record for an instruction that wrote no file register
+NOWRITE = 0xFFFF
+
+# what an address writes when it isn't a file register f: nothing, an address through an FSR
+# or not found yet
+NONE = -1
+INDIRECT = -2
+UNSEEN = -3
+
+# records held in the ring buffer
+CAPACITY = 0x10000
+
+# records per chunk of a chunked trace, the suffix of its index file and the zlib level used.
+# the lowest level keeps compressing from slowing the traced run much
+CHUNK = 0x10000
+INDEX = '.idx'
+LEVEL = 1
+
+# offset and length of a chunk in the trace file, number of records, first and last cycle and
+# the length of the compressed address bitmap that follows
+ENTRY = struct.Struct('<QIIQQI')
+
+# bytes of the address bitmap, one bit for each word of the largest program memory
+PCMAP = 0x8000 // 8
+
+
+def writes(ins):
+    ''' the file register f ins writes, INDIRECT for MOVWI or NONE '''
+    if ins is None:
+        return NONE
+    elif ins.info.mnemonic == 'MOVWI':
+        return INDIRECT
+    elif isa.writes(ins):
+        return ins.f
+    return NONE
+
+
+def dtype():
+    ''' numpy dtype of a record '''
+    import numpy as np
+    return np.dtype(FIELDS)
+
+
+def load(filename):
+    ''' map a trace file as a numpy array of records '''
+    import numpy as np
+    return np.memmap(filename, dtype(), mode='r')
+
+
+def encode(data):
+    ''' delta encode and compress a chunk of records '''
+    size = RECORD.size
+    x = int.from_bytes(data, 'big')
+    delta = (x ^ (x >> 8 * size)).to_bytes(len(data), 'big')
+    return zlib.compress(b''.join(delta[k::size] for k in range(size)), LEVEL)
+
+
+def decode(blob, count):
+    ''' decompress and undo the delta encoding of a chunk of count records '''
+    size = RECORD.size
+    length = count * size
+    planes = zlib.decompress(blob)
+    delta = bytearray(length)
+    for k in range(size):
+        delta[k::size] = planes[k * count:(k + 1) * count]
+    x = int.from_bytes(delta, 'big')
+
+    # each record is the xor of every delta up to it.  doubling the shift each pass gets
+    # there in log2(count) passes
+    shift = 8 * size
+    while shift < 8 * length:
+        x ^= x >> shift
+        shift *= 2
+    return x.to_bytes(length, 'big')
+
+
+def pcmap(data):
+    ''' compressed bitmap of the addresses run by a chunk of records '''
+    bitmap = bytearray(PCMAP)
+    for lo, hi in set(zip(data[PC::RECORD.size], data[PC + 1::RECORD.size])):
+        pc = (hi << 8) | lo
+        bitmap[pc >> 3] |= 1 << (pc & 7)
+    return zlib.compress(bytes(bitmap))
+
+
+class ChunkWriter:
+    ''' file like writer of records to a chunked trace and its index '''
+
+    def __init__(self, filename, chunk=CHUNK):
+        self.file = open(filename, 'wb')
+        self.index = open(filename + INDEX, 'wb')
+        self.size = chunk * RECORD.size
+        self.pending = bytearray()
+        self.offset = 0
+
+    def write(self, data):
+        ''' add records, writing out every chunk they complete '''
+        self.pending += data
+        while len(self.pending) >= self.size:
+            self.emit(self.pending[:self.size])
+            del self.pending[:self.size]
+
+    def emit(self, data):
+        blob = encode(data)
+        pcs = pcmap(data)
+        first = RECORD.unpack_from(data, 0)[0]
+        last = RECORD.unpack_from(data, len(data) - RECORD.size)[0]
+        self.index.write(ENTRY.pack(self.offset, len(blob), len(data) // RECORD.size, first,
+                                    last, len(pcs)) + pcs)
+        self.file.write(blob)
+        self.offset += len(blob)
+
+    def flush(self):
+        self.file.flush()
+        self.index.flush()
+
+    def close(self):
+        ''' write the last, short, chunk and close the files '''
+        if self.pending:
+            self.emit(bytes(self.pending))
+            self.pending.clear()
+        self.file.close()
+        self.index.close()
+
+
+class TraceFile:
+    ''' a chunked trace opened for reading.  only the index is read when it is opened.  chunks
+    are decoded when a lookup needs them and the last one decoded is kept '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offsets, self.lengths, self.counts, self.first, self.last = [], [], [], [], []
+        self.maps = []
+        with open(filename + INDEX, 'rb') as fp:
+            index = fp.read()
+        position = 0
+        while position < len(index):
+            offset, length, count, first, last, size = ENTRY.unpack_from(index, position)
+            position += ENTRY.size
+            self.offsets.append(offset)
+            self.lengths.append(length)
+            self.counts.append(count)
+            self.first.append(first)
+            self.last.append(last)
+            self.maps.append(index[position:position + size])
+            position += size
+
+        # number of the first record of each chunk
+        self.starts = [0]
+        for count in self.counts:
+            self.starts.append(self.starts[-1] + count)
+
+        self.data = None
+        self.cached = None, None
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def chunk(self, i):
+        ''' bytes of the records of chunk i '''
+        if self.cached[0] != i:
+            if self.data is None:
+                with open(self.filename, 'rb') as fp:
+                    self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            blob = self.data[self.offsets[i]:self.offsets[i] + self.lengths[i]]
+            self.cached = i, decode(blob, self.counts[i])
+        return self.cached[1]
+
+    def __getitem__(self, n):
+        ''' record number n '''
+        if not 0 <= n < len(self):
+            raise IndexError(n)
+        i = bisect.bisect_right(self.starts, n) - 1
+        return RECORD.unpack_from(self.chunk(i), (n - self.starts[i]) * RECORD.size)
+
+    def find_cycle(self, cycle):
+        ''' number of the record of the instruction running at cycle, the last one starting
+        at or before it.  cycles only go up within a single run '''
+        i = bisect.bisect_right(self.first, cycle) - 1
+        if i < 0:
+            raise IndexError(cycle)
+        data = self.chunk(i)
+        lo, hi = 0, self.counts[i]
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if RECORD.unpack_from(data, mid * RECORD.size)[0] <= cycle:
+                lo = mid
+            else:
+                hi = mid
+        return self.starts[i] + lo
+
+    def at_cycle(self, cycle):
+        ''' record of the instruction running at cycle '''
+        return self[self.find_cycle(cycle)]
+
+    def at_pc(self, pc):
+        ''' (record number, record) of every instruction run at address pc.  chunks that
+        never ran it are skipped without being decoded '''
+        for i, compressed in enumerate(self.maps):
+            if not zlib.decompress(compressed)[pc >> 3] & (1 << (pc & 7)):
+                continue
+            data = self.chunk(i)
+            for n, record in enumerate(RECORD.iter_unpack(data), self.starts[i]):
+                if record[1] == pc:
+                    yield n, record
+
+    def array(self, i):
+        ''' numpy array of the records of chunk i '''
+        import numpy as np
+        return np.frombuffer(self.chunk(i), dtype())
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+
+class Trace:
+    ''' ring buffer of trace records.  with a filename the buffer is a map of the file, grown
+    when it fills so the file holds the whole run.  chunked instead writes the file as a
+    compressed chunked trace with an index, spilling the ring to it each time it fills '''
+
+    def __init__(self, capacity=CAPACITY, filename=None, chunked=False):
+        self.capacity = capacity
+
+        # next slot in the buffer, the slot that fills it and records taken before the first
+        # one in the buffer
+        self.index = 0
+        self.end = capacity
+        self.taken = 0
+        self.mapped = bool(filename) and not chunked
+        if self.mapped:
+            self.file = open(filename, 'w+b')
+            self.file.truncate(RECORD.size * capacity)
+            self.buffer = mmap.mmap(self.file.fileno(), RECORD.size * capacity)
+        else:
+            self.file = ChunkWriter(filename) if filename else None
+            self.buffer = bytearray(RECORD.size * capacity)
+
+        # the Pic being traced and the indirect write made by the instruction being run
+        self.pic = None
+        self.address = NOWRITE
+        self.value = 0
+
+    def attach(self, pic):
+        ''' start catching the indirect writes of pic.  returns the step function that runs
+        and records one instruction '''
+        self.pic = pic
+        self._store_indirect = pic.store_indirect
+        pic.store_indirect = self.store_indirect
+
+        # the step is a closure over everything it touches as it runs for every instruction
+        pack, size = RECORD.pack_into, RECORD.size
+        buffer, mem, words, ops, profile = self.buffer, pic.mem, pic.words, pic.ops, pic.cycles
+        ran, cells, instruction = pic.ran, pic.map, pic.instruction
+        cell_wreg, cell_status, cell_bsr = pic.cell_wreg, pic.cell_status, pic.cell_bsr
+        cell_stkptr, cell_pcl = pic.cell_stkptr, pic.cell_pcl
+        sync = pic.sync_status
+
+        # what each address writes, found the first time it runs
+        kinds = [UNSEEN] * len(ops)
+
+        def step():
+            pc = (pic.pch << 8) | mem[cell_pcl]
+            kind = kinds[pc]
+            if kind == UNSEEN:
+                kind = kinds[pc] = writes(instruction(pc))
+
+            # what Pic.exec does, with the pc property written out
+            handler, ins, cycles = ops[pc]
+            pic.ins_pc = pc
+            pic.pch, mem[cell_pcl] = divmod(pc + 1, 0x100)
+            profile[pc] += cycles
+            ran[pc] = 1
+            cycle = pic.cycle_count
+            pic.cycle_count = cycle + cycles
+            pic.instruction_count += 1
+
+            if kind >= 0:
+                address = (mem[cell_bsr] << 7) | kind
+                handler(ins)
+                if pic.alu:
+                    sync()
+                value = mem[cells[address]]
+            elif kind == NONE:
+                handler(ins)
+                if pic.alu:
+                    sync()
+                address, value = NOWRITE, 0
+            else:
+                self.address, self.value = NOWRITE, 0
+                handler(ins)
+                if pic.alu:
+                    sync()
+                address, value = self.address, self.value
+
+            index = self.index
+            pack(buffer, index * size, cycle, pc, words[pc], address, value,
+                 mem[cell_wreg], mem[cell_status], mem[cell_bsr], mem[cell_stkptr])
+            index += 1
+            self.index = self.full(index) if index == self.end else index
+
+        return step
+
+    def detach(self):
+        ''' put the Pic's own store_indirect back '''
+        del self.pic.store_indirect
+        self.pic = None
+
+    def store_indirect(self, address, value):
+        if address < self.pic.data.linear:
+            self.address = address
+            self.value = value & 0xFF
+        self._store_indirect(address, value)
+
+    def full(self, index):
+        ''' make room when the buffer fills at index and return the next slot.  a map
+        doubles the file, a chunked trace spills the ring and a plain ring starts over '''
+        if self.mapped:
+            self.end *= 2
+            self.buffer.resize(RECORD.size * self.end)
+            return index
+        if self.file:
+            self.index = index
+            self.flush()
+        else:
+            self.taken += index
+        return 0
+
+    def flush(self):
+        ''' spill the records in the ring to a chunked trace '''
+        self.file.write(self.buffer[:self.index * RECORD.size])
+        self.file.flush()
+        self.taken += self.index
+        self.index = 0
+
+    def close(self):
+        ''' finish the file, cutting a map down to the records taken '''
+        if self.mapped:
+            self.buffer.close()
+            self.file.truncate(RECORD.size * self.index)
+            self.file.close()
+            self.mapped = False
+            self.buffer = bytearray()
+            self.taken, self.index = self.index, 0
+            self.file = None
+        elif self.file:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    @property
+    def count(self):
+        ''' records taken in all '''
+        return self.taken + self.index
+
+    def records(self):
+        ''' bytes of the records held in the buffer, oldest first '''
+        end = self.index * RECORD.size
+        if self.file or self.count <= self.capacity:
+            return bytes(self.buffer[:end])
+        return bytes(self.buffer[end:] + self.buffer[:end])
+
+    def __iter__(self):
+        ''' unpacked records held in the buffer, oldest first '''
+        return RECORD.iter_unpack(self.records())
+
+    def array(self):
+        ''' numpy array of the records held in the buffer, oldest first '''
+        import numpy as np
+        return np.frombuffer(self.records(), dtype())
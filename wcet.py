@@ -0,0 +1,272 @@
+'''
+static best and worst case cycle counts.
+
+the control flow graph is built from the decoded program, starting at an address and
+following every path until it reaches the end address, or for a routine with no end address
+until it returns.  each edge costs the cycles of the instruction it leaves, taken from the
+cycles column of the instruction table.  a skip instruction has two edges, one to the next
+instruction at its first cost and one over it at its second, '1,2'.  a CALL edge adds the
+best and worst case of the routine it calls, analysed the same way.  GOTO and CALL are taken
+to stay in the page of the instruction, i.e. PCLATH is assumed to match it.
+
+loops are the strongly connected parts of the graph.  each one is collapsed, innermost first,
+into a single node: its body is solved as a graph of its own with the edges back to the loop
+header leading out of it, which gives the cost of one iteration and of the last iteration to
+each exit.  bounds gives the most iterations, or (fewest, most), for a loop by the address
+or label of its header, the instruction at the top of the loop run once per iteration.  what
+is left is acyclic and the shortest and longest paths through it are the best and worst case.
+
+anything the analysis can't follow is reported as an issue rather than silently ignored:
+loops with no bound, which are counted as running once, computed jumps (BRW, CALLW and
+writes to PCL), recursion, SLEEP, RESET and unprogrammed words.  a path stops at each of them
+so the counts of a Bound with issues don't cover every path.  MOVWI stores through an FSR
+whose value isn't followed, so it may write PCL too.  each one is reported as a possible
+computed jump and the path carries on past it as if it didn't.
+'''
+
+import collections
+
+import pic
+import isa
+
+# the cycles and path of a run, (address, text) of anything not analysed and loops by header
+Bound = collections.namedtuple('Bound', 'best worst issues loops')
+
+# stand in for the end of the analysed code
+EXIT = 'exit'
+
+
+class Analyzer:
+    ''' static analysis of the program loaded in a Pic '''
+
+    def __init__(self, pic, symtab=None, bounds=None):
+        self.pic = pic
+        self.symtab = symtab or {}
+        self.bounds = {self.address(k): v if isinstance(v, tuple) else (1, v)
+                       for k, v in (bounds or {}).items()}
+        self.issues = []
+        self.loops = {}
+
+        # (best, worst) of routines by entry address and those being analysed
+        self.routines = {}
+        self.active = set()
+
+    def address(self, label):
+        return pic.lookup(self.symtab, label)
+
+    def flag(self, address, text):
+        if (address, text) not in self.issues:
+            self.issues.append((address, text))
+
+    def edges(self, a, end):
+        ''' (successor, best, worst) of each way out of the instruction at a '''
+        ins = self.pic.instruction(a) if a < len(self.pic.words) else None
+        if ins is None:
+            self.flag(a, 'unprogrammed')
+            return []
+
+        info = ins.info
+        mnemonic = info.mnemonic
+        cycles = [int(c) for c in info.cycles.split(',')]
+        page = a & 0x7800
+        if mnemonic in ('BRW', 'CALLW'):
+            self.flag(a, 'computed jump')
+            return []
+        if ins.f is not None and ins.f & 0x7F == isa.PCL and isa.writes(ins):
+            self.flag(a, 'computed jump')
+            return []
+        if mnemonic == 'MOVWI':
+            self.flag(a, 'indirect write, may be a computed jump')
+        if mnemonic in ('SLEEP', 'RESET'):
+            self.flag(a, mnemonic.lower())
+            return []
+        if mnemonic in isa.RETURNS:
+            return [(EXIT, cycles[0], cycles[0])] if end is None else []
+
+        if mnemonic == 'GOTO':
+            out = [(page | ins.k, cycles[0], cycles[0])]
+        elif mnemonic == 'BRA':
+            out = [(a + 1 + pic.twos_complement(ins.k, 9), cycles[0], cycles[0])]
+        elif mnemonic == 'CALL':
+            best, worst = self.routine(page | ins.k, a)
+            if best is None:
+                return []
+            out = [(a + 1, cycles[0] + best, cycles[0] + worst)]
+        elif mnemonic in isa.SKIPS:
+            out = [(a + 1, cycles[0], cycles[0]), (a + 2, cycles[-1], cycles[-1])]
+        else:
+            out = [(a + 1, cycles[0], cycles[0])]
+        return [(EXIT if v == end else v, b, w) for v, b, w in out]
+
+    def routine(self, entry, caller):
+        ''' (best, worst) cycles of a call to entry, from the instruction at entry through its
+        return '''
+        if entry in self.active:
+            self.flag(caller, 'recursion')
+            return None, None
+        if entry not in self.routines:
+            self.active.add(entry)
+            result = self.solve(self.graph(entry, None), entry).get(EXIT)
+            self.active.discard(entry)
+            if result is None:
+                self.flag(entry, 'routine does not return')
+            self.routines[entry] = result or (None, None)
+        return self.routines[entry]
+
+    def graph(self, start, end):
+        ''' edges of every instruction reachable from start '''
+        graph = {}
+        pending = [start]
+        while pending:
+            a = pending.pop()
+            if a in graph:
+                continue
+            graph[a] = self.edges(a, end)
+            pending.extend(v for v, _, _ in graph[a] if v != EXIT and v not in graph)
+        return graph
+
+    def solve(self, graph, entry):
+        ''' (best, worst) cycles from entry to each node outside graph it can reach '''
+        predecessors = collections.defaultdict(set)
+        for u, out in graph.items():
+            for v, _, _ in out:
+                predecessors[v].add(u)
+
+        # collapse each loop into its header
+        dag = {}
+        member = {}
+        for scc in components(graph):
+            u = scc[0]
+            if len(scc) == 1 and u not in predecessors[u]:
+                dag[u] = graph[u]
+                member[u] = u
+                continue
+
+            nodes = set(scc)
+            headers = [a for a in scc if a == entry or predecessors[a] - nodes]
+            header = entry if entry in nodes else min(headers)
+            if len(headers) > 1:
+                self.flag(header, 'loop with more than one entry')
+            for a in scc:
+                member[a] = header
+
+            # the body is solved with the edges back to the header leading out of it
+            back = ('back', header)
+            body = {u: [(back if v == header else v, b, w) for v, b, w in graph[u]]
+                    for u in scc}
+            costs = self.solve(body, header)
+            fewest, most = self.bounds.get(header, (1, None))
+            if most is None:
+                self.flag(header, 'unbounded loop')
+                most = fewest
+            lo, hi = costs.pop(back, (0, 0))
+            self.loops[header] = (lo, hi, fewest, most)
+            dag[header] = [(v, (fewest - 1) * lo + b, (most - 1) * hi + w)
+                           for v, (b, w) in costs.items()]
+
+        # edges between loops and instructions left.  what is left is acyclic
+        dag = {u: [(member.get(v, v), b, w) for v, b, w in out if member.get(v, v) != u]
+               for u, out in dag.items()}
+
+        # shortest and longest paths in topological order
+        start = member[entry]
+        best, worst = {start: 0}, {start: 0}
+        result = {}
+        for u in topological(dag, start):
+            for v, b, w in dag[u]:
+                table = (best, worst) if v in dag else None
+                lo, hi = (best.get(v), worst.get(v)) if table else result.get(v, (None, None))
+                lo = best[u] + b if lo is None else min(lo, best[u] + b)
+                hi = worst[u] + w if hi is None else max(hi, worst[u] + w)
+                if table:
+                    best[v], worst[v] = lo, hi
+                else:
+                    result[v] = lo, hi
+        return result
+
+    def analyze(self, start, end=None):
+        ''' Bound of the cycles from start to end, or through the return of the routine at
+        start if end is None.  start and end are addresses or labels '''
+        start = self.address(start)
+        end = None if end is None else self.address(end)
+        if end is None:
+            self.active.add(start)
+        result = self.solve(self.graph(start, end), start).get(EXIT)
+        self.active.discard(start)
+        if result is None:
+            self.flag(start, 'end not reached')
+            result = None, None
+        loops = {self.name(a): loop for a, loop in self.loops.items()}
+        return Bound(result[0], result[1], [(self.name(a), text) for a, text in self.issues],
+                     loops)
+
+    def name(self, address):
+        names = {v: k for k, v in self.symtab.items()}
+        return names.get(address, address)
+
+
+def analyze(pic, start, end=None, bounds=None, symtab=None):
+    ''' best and worst case cycles from start to end, see Analyzer.analyze '''
+    return Analyzer(pic, symtab, bounds).analyze(start, end)
+
+
+def components(graph):
+    ''' strongly connected components of graph, Tarjan's algorithm without recursion '''
+    index, low, stack, on_stack = {}, {}, [], set()
+    result = []
+    counter = 0
+    for root in graph:
+        if root in index:
+            continue
+        work = [(root, iter(graph[root]))]
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            u, successors = work[-1]
+            for v, _, _ in successors:
+                if v not in graph:
+                    continue
+                if v not in index:
+                    index[v] = low[v] = counter
+                    counter += 1
+                    stack.append(v)
+                    on_stack.add(v)
+                    work.append((v, iter(graph[v])))
+                    break
+                if v in on_stack:
+                    low[u] = min(low[u], index[v])
+            else:
+                work.pop()
+                if work:
+                    low[work[-1][0]] = min(low[work[-1][0]], low[u])
+                if low[u] == index[u]:
+                    scc = []
+                    while True:
+                        v = stack.pop()
+                        on_stack.discard(v)
+                        scc.append(v)
+                        if v == u:
+                            break
+                    result.append(scc)
+    return result
+
+
+def topological(graph, entry):
+    ''' nodes of an acyclic graph reachable from entry, each before its successors '''
+    order, seen = [], set()
+    work = [(entry, iter(graph[entry]))]
+    seen.add(entry)
+    while work:
+        u, successors = work[-1]
+        for v, _, _ in successors:
+            if v in graph and v not in seen:
+                seen.add(v)
+                work.append((v, iter(graph[v])))
+                break
+        else:
+            work.pop()
+            order.append(u)
+    order.reverse()
+    return order